@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of raw to text conversions, so output converted before, re-run after
+'log --append' or in batch or CI retries, is copied rather than parsed again.
+
+Entries are keyed by a BLAKE2 hash of the raw output, the conversion options
+and the converter itself.  Each entry holds the text and, as requested, its
+line index and style table, along with the converter's checkpoint in
+<key>.json, written last so an entry without it is incomplete.  Once the
+entries total more than the cache's size, the least recently used are
+removed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from functools import lru_cache
+from contextlib import nullcontext
+
+from .vendor import raw_to_text
+from .vendor.raw_to_text import raw_to_text_mmap, PARALLEL_THRESHOLD
+
+# ------------------------------------------------------------------------------
+
+# Changed when the layout of the entries changes
+CACHE_VERSION = 1
+
+CACHE_SIZE = 1024 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Files of an entry, by the keyword naming them, and the meta data last
+SUFFIXES = {'text': '.txt', 'index': '.idx', 'styles': '.sty'}
+META_SUFFIX = '.json'
+
+# ------------------------------------------------------------------------------
+
+
+@lru_cache(maxsize=None)
+def converter_digest():
+    """Hash of the converter's source, which any change to it changes."""
+    with open(raw_to_text.__file__, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+class ConversionCache(object):
+    """
+    Conversions of raw output held in directory, of at most size bytes in
+    all.  The directory is created as needed.
+    """
+
+    def __init__(self, directory, size=CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+
+    def key(self, in_f, **options):
+        """
+        The key of the conversion of the raw file in_f with options, hashed
+        from its start.  The file is left at its start.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps([CACHE_VERSION, converter_digest(), options],
+                                 sort_keys=True).encode())
+        in_f.seek(0)
+        while True:
+            chunk = in_f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+        in_f.seek(0)
+        return digest.hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def fetch(self, key, link=False, **files):
+        """
+        Write the files of the entry key to the paths of files, by keyword
+        of SUFFIXES, hard linked if link, else copied.  Returns the entry's
+        checkpoint, or None if there is no such entry.  The use of an entry
+        makes it the most recently used.
+        """
+        meta_path = self.path(key, META_SUFFIX)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            # A hard linked file changed since is not used, nor kept
+            for name in files:
+                if os.path.getsize(self.path(key, SUFFIXES[name])) != meta['sizes'][name]:
+                    raise ValueError(name)
+            for name, dest in files.items():
+                _install(self.path(key, SUFFIXES[name]), dest, link)
+        except (OSError, ValueError, KeyError):
+            self.remove(key)
+            return None
+        os.utime(meta_path)
+        return meta['checkpoint']
+
+    def store(self, key, checkpoint, link=False, **files):
+        """
+        Add the files, by keyword of SUFFIXES, of the conversion with
+        checkpoint as the entry key, then evict the least recently used
+        entries beyond the cache size.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        sizes = {}
+        for name, source in files.items():
+            _install(source, self.path(key, SUFFIXES[name]), link)
+            sizes[name] = os.path.getsize(source)
+        meta_path = self.path(key, META_SUFFIX)
+        _atomic_write(meta_path, json.dumps({'checkpoint': checkpoint, 'sizes': sizes}))
+        self.evict()
+
+    def remove(self, key):
+        for suffix in list(SUFFIXES.values()) + [META_SUFFIX]:
+            try:
+                os.remove(self.path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """
+        The (last use, size, key) of each entry, the size counting the files
+        of entries being written, and of incomplete ones.
+        """
+        used = {}
+        sizes = {}
+        try:
+            scan = os.scandir(self.directory)
+        except FileNotFoundError:
+            return []
+        with scan:
+            for entry in scan:
+                key = entry.name.partition('.')[0]
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                sizes[key] = sizes.get(key, 0) + st.st_size
+                if entry.name == key + META_SUFFIX:
+                    used[key] = st.st_mtime_ns
+        # Incomplete entries go first
+        return [(used.get(key, 0), size, key) for key, size in sizes.items()]
+
+    def evict(self):
+        """Remove the least recently used entries while over the cache size."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.size:
+                break
+            self.remove(key)
+            total -= size
+
+
+def _install(source, dest, link):
+    """Replace dest by a copy of source, or a hard link if link and possible."""
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        if link:
+            try:
+                os.link(source, tmp)
+            except OSError:
+                link = False
+        if not link:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _atomic_write(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# ------------------------------------------------------------------------------
+
+
+def raw_to_text_cached(cache, raw_file, text_file, index_file=None, styles_file=None,
+                       link=False, verbose=False, jobs=1,
+                       parallel_threshold=PARALLEL_THRESHOLD, max_line=0, split_marker=''):
+    """
+    raw_to_text_mmap() of the file raw_file into the file text_file, and the
+    index_file and styles_file if given, unless the same conversion is in
+    cache, a ConversionCache or None, in which case the files are written
+    from it.  Hits are hard linked if link, else copied.  Returns the
+    converter's checkpoint.
+    """
+    files = {'text': text_file}
+    if index_file:
+        files['index'] = index_file
+    if styles_file:
+        files['styles'] = styles_file
+
+    with open(raw_file, 'rb') as in_f:
+        key = None
+        if cache is not None:
+            key = cache.key(in_f, max_line=max_line, split_marker=split_marker,
+                            files=sorted(files))
+            checkpoint = cache.fetch(key, link=link, **files)
+            if checkpoint is not None:
+                if verbose:
+                    print('-- raw output converted before, text from cache')
+                return checkpoint
+        with open(text_file, 'wb') as out_f, \
+                open(index_file, 'wb') if index_file else nullcontext() as index, \
+                open(styles_file, 'wb') if styles_file else nullcontext() as styles:
+            checkpoint = raw_to_text_mmap(in_f, out_f, jobs=jobs,
+                                          parallel_threshold=parallel_threshold,
+                                          max_line=max_line, split_marker=split_marker,
+                                          index=index, styles=styles)
+
+    if key is not None:
+        cache.store(key, checkpoint, link=link, **files)
+    return checkpoint
@@ -38,6 +38,49 @@ Optional arguments :
   --raw-file <raw-file>
                  Retain unfiltered output in <log-raw>.  Implies '--raw'.
 
+  -j <n>, --jobs <n>
+                 Convert raw output to text using up to <n> processes,
+                 0 for one per CPU, after the command completed rather
+                 than as it is captured, unless 1 [default: 1].
+
+  --parallel-min <mb>
+                 Only convert in parallel when the raw output is at
+                 least <mb> megabytes [default: 64].
+
+  --max-line <n>
+                 Split text lines longer than <n> characters, so very
+                 long lines are never held whole, 0 for no limit
+                 [default: 0].
+
+  --split-marker <text>
+                 Text ending each piece of a split line [default: ].
+
+  --index        Also write <log-file>.idx, indexing the offsets of each
+                 text line in <log-file> and in the raw output.
+
+  --styles       Also write <log-file>.sty, the table of the colors and
+                 styles of the text in <log-file>, so the raw output is no
+                 longer needed to view it in color.
+
+  --cache <dir>  Convert raw output to text after the command completed,
+                 keeping the text in <dir>, and copy it from there when the
+                 same output is converted again with the same options.
+
+  --cache-size <mb>
+                 Remove the least recently used conversions once those in
+                 the cache total more than <mb> megabytes [default: 1024].
+
+  --overflow <policy>
+                 When the terminal or <log-file> falls behind the output,
+                 block the command, drop what the terminal cannot take,
+                 still writing <log-file> whole, or spill it to a temporary
+                 file until it catches up : block, drop or spill
+                 [default: block].
+
+  --splice       On Linux, move the output to the terminal and <log-file>
+                 in the kernel rather than through Python.  Output converted
+                 as it is captured is not.
+
 NOT YET IMPLEMENTED :
 X -s, --silent   Silence STDOUT.  Output only to <log-file> (-q -n).
 """
@@ -93,6 +136,8 @@ Optional arguments :
 from prettyprinter import cpprint as pp
 import sys
 import os
+import json
+import shutil
 from dataclasses import dataclass
 
 from .vendor.docopt import docopt
@@ -103,7 +148,9 @@ from .vendor.docopt import docopt
 
 from plumbum import RETCODE
 from plumbum.commands.processes import ProcessExecutionError
-from .vendor.raw_to_text import raw_to_text
+from .vendor.raw_to_text import RawToText, PARALLEL_THRESHOLD
+from .cache import ConversionCache, raw_to_text_cached
+from contextlib import nullcontext
 
 from logtool import __version__
 
@@ -161,16 +208,60 @@ def perform(cfg):
         argv.insert(0, '--time')		# applies to script
     if cfg.wallclock:
         argv.insert(0, '--wallclock')	# applies to script
+    argv[0:0] = ['--overflow', cfg.overflow]
+    if cfg.splice:
+        argv.insert(0, '--splice')
 
     # print(f"{argv = }")
 
+    # Unless appending to earlier output, or converting in parallel or
+    # through the cache, convert to text as the output is captured rather
+    # than afterwards.  The checkpoint of a live conversion is only written
+    # if it succeeds, otherwise the raw output is converted again.
+    textfile = cfg.textfile
+    live_checkpoint = None
+    if not cfg.raw and not cfg.append and cfg.jobs == 1 and cfg.cache is None:
+        textfile = cfg.logfile + '.txt'
+        live_checkpoint = cfg.logfile + CHECKPOINT_SUFFIX + '.tmp'
+    elif cfg.raw and textfile and cfg.mode == 'w':
+        # The caller's text file, the raw output left as is
+        live_checkpoint = textfile + CHECKPOINT_SUFFIX + '.tmp'
+    if live_checkpoint:
+        argv[0:0] = ['--checkpoint', live_checkpoint]
+    if textfile:
+        argv[0:0] = ['--text', textfile, '--max-line', str(cfg.max_line),
+                     '--split-marker=' + cfg.split_marker]
+        if cfg.indexfile:
+            argv[0:0] = ['--index', cfg.indexfile]
+        if cfg.stylesfile:
+            argv[0:0] = ['--styles', cfg.stylesfile]
+
+    # When appending to a log converted earlier, continue that conversion
+    # from its checkpoint rather than converting the whole log again.
+    checkpoint = None
+    if not cfg.raw and cfg.append:
+        checkpoint = read_checkpoint(cfg.logfile)
+
     if cfg.show:
         if cfg.verbose:
             print("+ script '{}'".format("' '".join(argv)))
         else:
             print("+ " + command_line + "\n")
+        raw_offset = 0
+        if cfg.mode == 'a' and os.path.exists(cfg.logfile):
+            raw_offset = os.path.getsize(cfg.logfile)
         with open(cfg.logfile, cfg.mode) as f:
             print(f"+ {command_line}\n", file=f)
+        if textfile:
+            # Converted, as the output to follow, to index it
+            with open(textfile, cfg.mode + 'b') as f, \
+                    open(cfg.indexfile, cfg.mode + 'b') if cfg.indexfile else nullcontext() as index, \
+                    open(cfg.stylesfile, cfg.mode + 'b') if cfg.stylesfile else nullcontext() as styles:
+                converter = RawToText(f, max_line=cfg.max_line, split_marker=cfg.split_marker,
+                                      index=index, raw_offset=raw_offset,
+                                      text_offset=f.tell(), styles=styles)
+                converter.feed(f"+ {command_line}\n\n".encode())
+                converter.close()
         # argv.insert(0, '--append')
         sys.stdout.flush()
 
@@ -193,17 +284,52 @@ def perform(cfg):
 
         if cfg.debug:
             print('log:  retcode = {}'.format(str(retcode)))
+        if cfg.raw and live_checkpoint:
+            try:
+                os.remove(live_checkpoint)
+            except FileNotFoundError:
+                if cfg.verbose:
+                    print('-- converting raw output to text again')
+                try:
+                    raw_to_text_cached(None, cfg.logfile, textfile, cfg.indexfile,
+                                       cfg.stylesfile, max_line=cfg.max_line,
+                                       split_marker=cfg.split_marker)
+                except Exception:
+                    print("*** raw to text conversion failed, raw logfile unchanged.")
         if not cfg.raw :
-            if cfg.verbose:
-                print('-- converting raw output to text using raw_to_text')
             raw_file = cfg.logfile + '.raw'
             txt_file = cfg.logfile + '.txt'
             try:
-                with open(cfg.logfile, 'r') as in_f, open(txt_file, 'w') as out_f:
-                    raw_to_text(in_f, out_f)
-                os.rename(cfg.logfile, raw_file)
-                os.rename(txt_file, cfg.logfile)
+                if checkpoint is not None:
+                    if cfg.verbose:
+                        print('-- converting appended raw output to text from checkpoint')
+                    checkpoint = convert_appended(cfg.logfile, raw_file, txt_file,
+                                                  checkpoint, cfg.max_line,
+                                                  cfg.split_marker, cfg.indexfile,
+                                                  cfg.stylesfile)
+                else:
+                    if live_checkpoint:
+                        try:
+                            with open(live_checkpoint, 'r') as f:
+                                checkpoint = json.load(f)
+                            os.remove(live_checkpoint)
+                        except FileNotFoundError:
+                            # The live conversion failed, done again
+                            textfile = None
+                    if checkpoint is None and textfile != txt_file:
+                        if cfg.verbose:
+                            print('-- converting raw output to text using raw_to_text_mmap')
+                        # Copied from the cache, as a log may be appended to
+                        checkpoint = raw_to_text_cached(
+                            cfg.cache, cfg.logfile, txt_file, cfg.indexfile,
+                            cfg.stylesfile, verbose=cfg.verbose, jobs=cfg.jobs,
+                            parallel_threshold=cfg.parallel_threshold,
+                            max_line=cfg.max_line, split_marker=cfg.split_marker)
+                    os.rename(cfg.logfile, raw_file)
+                    os.rename(txt_file, cfg.logfile)
+                write_checkpoint(cfg.logfile, checkpoint)
             except Exception:
+                write_checkpoint(cfg.logfile, None)
                 print("*** raw to text conversion failed, raw logfile unchanged.")
         return retcode
 
@@ -223,19 +349,127 @@ def perform(cfg):
 
 # ------------------------------------------------------------------------------
 
+# Converter checkpoints, saved alongside the text log as <log-file>.ckpt, let
+# 'log --append' convert only the output it appends.  A checkpoint is only
+# used while the log's size and modification time are as recorded.
+
+CHECKPOINT_SUFFIX = '.ckpt'
+INDEX_SUFFIX = '.idx'
+STYLES_SUFFIX = '.sty'
+CHECKPOINT_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+def read_checkpoint(logfile):
+
+    try:
+        with open(logfile + CHECKPOINT_SUFFIX, 'r') as f:
+            checkpoint = json.load(f)
+        st = os.stat(logfile)
+    except (OSError, ValueError):
+        return None
+
+    if (not isinstance(checkpoint, dict)
+            or checkpoint.get('version') != CHECKPOINT_VERSION
+            or checkpoint.get('size') != st.st_size
+            or checkpoint.get('mtime_ns') != st.st_mtime_ns):
+        return None
+
+    return checkpoint
+
+
+def write_checkpoint(logfile, converter_checkpoint):
+
+    path = logfile + CHECKPOINT_SUFFIX
+
+    if converter_checkpoint is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    st = os.stat(logfile)
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'converter': converter_checkpoint,
+    }
+    with open(path, 'w') as f:
+        json.dump(checkpoint, f)
+
+
+def convert_appended(logfile, raw_file, txt_file, checkpoint, max_line=0, split_marker='',
+                     indexfile=None, stylesfile=None):
+    """
+    Convert the raw output appended to <logfile> since <checkpoint>, adding
+    it to <raw_file>, and replace it in <logfile> by its text.  The line
+    index <indexfile> and style table <stylesfile>, if they exist, are
+    continued.  Returns the converter's checkpoint.
+    """
+
+    converted = checkpoint['size']
+    # The partial last line is written again by the continued conversion
+    resume = converted - checkpoint['converter']['tail']
+
+    if indexfile and not os.path.exists(indexfile):
+        indexfile = None
+    if stylesfile and not os.path.exists(stylesfile):
+        stylesfile = None
+    if stylesfile:
+        # As is its text, the style of the partial last line is written again
+        os.truncate(stylesfile, os.path.getsize(stylesfile)
+                    - checkpoint['converter'].get('styles_tail', 0))
+
+    with open(logfile, 'r+b') as log_f, open(raw_file, 'ab') as raw_f, \
+            open(txt_file, 'w+b') as txt_f, \
+            open(indexfile, 'ab') if indexfile else nullcontext() as index, \
+            open(stylesfile, 'ab') if stylesfile else nullcontext() as styles:
+        converter = RawToText(txt_f, max_line=max_line, split_marker=split_marker,
+                              index=index, styles=styles)
+        converter.restore(checkpoint['converter'])
+        log_f.seek(converted)
+        while True:
+            chunk = log_f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            raw_f.write(chunk)
+            converter.feed(chunk)
+        converter_checkpoint = converter.checkpoint()
+        converter.close()
+        txt_f.seek(0)
+        log_f.seek(resume)
+        log_f.truncate()
+        shutil.copyfileobj(txt_f, log_f, CHUNK_SIZE)
+
+    os.remove(txt_file)
+
+    return converter_checkpoint
+
+# ------------------------------------------------------------------------------
+
 @dataclass
 class ActionConfig (object):
     argv = []
     append = False
+    cache = None
     command = None
     debug = False
+    indexfile = None
+    jobs = 1
     logDir = None
     logfile = None
+    max_line = 0
     mode = None
+    overflow = 'block'
+    splice = False
+    parallel_threshold = PARALLEL_THRESHOLD
     quiet = False
     raw = False
     rawfile = None
     show = True
+    split_marker = ''
+    stylesfile = None
+    textfile = None
     verbose = False
     time = False
     wallclock = False
@@ -266,6 +500,26 @@ def configure(args):
 
     cfg.wallclock = args['--wallclock']
 
+    cfg.jobs = int(args['--jobs'])
+
+    cfg.parallel_threshold = int(float(args['--parallel-min']) * 1024 * 1024)
+
+    cfg.max_line = int(args['--max-line'])
+
+    cfg.split_marker = args['--split-marker']
+
+    cfg.overflow = args['--overflow']
+
+    cfg.splice = args['--splice']
+
+    cfg.indexfile = cfg.logfile + INDEX_SUFFIX if args['--index'] else None
+
+    cfg.stylesfile = cfg.logfile + STYLES_SUFFIX if args['--styles'] else None
+
+    if args['--cache']:
+        cfg.cache = ConversionCache(args['--cache'],
+                                    int(float(args['--cache-size']) * 1024 * 1024))
+
     cfg.show = not args['--no-show']
 
     cfg.mode = 'a' if cfg.append else 'w' # only applies to reporting the command
@@ -58,6 +58,44 @@ Log Output Options:
   -a, --append    If the target log file already exists, append to it
                   -- applicable when '--ts' or '--ref' are specified.
 
+Conversion Options:
+
+  -j <n>, --jobs <n>
+                  Convert raw output to text using up to <n> processes,
+                  0 for one per CPU, after the command completed rather
+                  than as it is captured, unless 1 [default: 1].
+
+  --parallel-min <mb>
+                  Only convert in parallel when the raw output is at
+                  least <mb> megabytes [default: 64].
+
+  --max-line <n>
+                  Split text lines longer than <n> characters, so very
+                  long lines are never held whole, 0 for no limit
+                  [default: 0].
+
+  --split-marker <text>
+                  Text ending each piece of a split line [default: ].
+
+  --index         Also write <base>/<date>/<time>/out.idx, indexing the
+                  offsets of each line in out.txt and in raw.dat.
+
+  --styles        Also write <base>/<date>/<time>/out.sty, the table of
+                  the colors and styles of the text in out.txt.
+
+  --html          Also render raw.dat, with its colors and styles, as an
+                  HTML document, <base>/<date>/<time>/out.html.
+
+  --cache <dir>   Convert raw.dat to text after the command completed,
+                  keeping the text in <dir>, and link it from there when
+                  the same output is converted again with the same
+                  options.
+
+  --cache-size <mb>
+                  Remove the least recently used conversions once those
+                  in the cache total more than <mb> megabytes
+                  [default: 1024].
+
 General Options:
 
   --help          Print this usage informatsion to STDERR and exit.
@@ -83,7 +121,8 @@ from dataclasses import dataclass
 import dateparser
 
 
-from .vendor.raw_to_text import raw_to_text
+from .vendor.raw_to_text import raw_to_html_bytes, PARALLEL_THRESHOLD
+from .cache import ConversionCache, raw_to_text_cached
 
 from pprint import PrettyPrinter
 pp = PrettyPrinter(indent=4).pprint
@@ -142,6 +181,19 @@ def perform(cfg):
     xfg.argv = cfg.argv
     xfg.time = cfg.time
     xfg.wallclock = cfg.wallclock
+    xfg.max_line = cfg.max_line
+    xfg.split_marker = cfg.split_marker
+
+    # Convert to text as the output is captured, unless in parallel or
+    # through the cache, after the command completed
+    if (cfg.clean and cfg.raw_name is not None
+            and cfg.jobs == 1 and cfg.cache is None):
+        xfg.textfile = os.path.join(cfg.log_dir, cfg.text_name)
+        if cfg.index:
+            xfg.indexfile = os.path.join(cfg.log_dir, cfg.index_name)
+        if cfg.styles:
+            xfg.stylesfile = os.path.join(cfg.log_dir, cfg.styles_name)
+        cfg.live = True
 
     try:
         retcode = log.perform(xfg)
@@ -176,11 +228,26 @@ def arrange_the_log_files(cfg):
 
         raw_file = cfg.log_file
         cfg.log_file = os.path.join(cfg.log_dir, cfg.text_name)
-        with open(raw_file, "r") as in_f, open(cfg.log_file, "w") as out_f:
-            raw_to_text(in_f, out_f)
+        if not cfg.live:
+            # out.txt is not written again, so may share the cached copy
+            index_file = os.path.join(cfg.log_dir, cfg.index_name) if cfg.index else None
+            styles_file = os.path.join(cfg.log_dir, cfg.styles_name) if cfg.styles else None
+            raw_to_text_cached(cfg.cache, raw_file, cfg.log_file, index_file, styles_file,
+                               link=True,
+                               verbose=cfg.verbose, jobs=cfg.jobs,
+                               parallel_threshold=cfg.parallel_threshold,
+                               max_line=cfg.max_line, split_marker=cfg.split_marker)
         if not os.path.exists(cfg.log_file):
             raise ValueError("raw to text conversion failed.  Text-only log " +
                              "'%s' does not exist." % (cfg.log_file))
+        if cfg.html:
+            html_file = os.path.join(cfg.log_dir, cfg.html_name)
+            with open(raw_file, "rb") as in_f, open(html_file, "wb") as out_f:
+                raw_to_html_bytes(in_f, out_f, max_line=cfg.max_line,
+                                  split_marker=cfg.split_marker,
+                                  title=' '.join([cfg.command] + cfg.argv))
+            if not cfg.quiet:
+                print("And the HTML file is %s" % (html_file))
         # Script done, file is log/build/2019-03-30/02-28-52/raw.dat
         # ....... text file is log/build/2019-03-30/02-28-52/out.txt
         if not cfg.quiet:
@@ -258,6 +325,18 @@ class ActionConfig (object):
     clean : bool = False
     raw_name : str = None
     text_name : str = None
+    jobs : int = 1
+    parallel_threshold : int = PARALLEL_THRESHOLD
+    max_line : int = 0
+    split_marker : str = ''
+    index : bool = False
+    index_name : str = None
+    styles : bool = False
+    styles_name : str = None
+    html : bool = False
+    html_name : str = None
+    live : bool = False
+    cache : ConversionCache = None
 
 # ------------------------------------------------------------------------------
 
@@ -303,6 +382,9 @@ def configure(args):
         cfg.log_dir = os.path.join(cfg.log_date_dir, cfg.time_string)
         cfg.raw_name = cfg.log_prefix + 'raw.dat'
         cfg.text_name = cfg.log_prefix + 'out.txt'
+        cfg.index_name = cfg.log_prefix + 'out.idx'
+        cfg.styles_name = cfg.log_prefix + 'out.sty'
+        cfg.html_name = cfg.log_prefix + 'out.html'
         cfg.log_name = cfg.raw_name
         os.environ['LOGTS_LOG_DIR'] = cfg.log_dir
     else:
@@ -321,6 +403,24 @@ def configure(args):
 
     cfg.mode = 'a' if cfg.append else 'w'
 
+    cfg.jobs = int(args['--jobs'])
+
+    cfg.parallel_threshold = int(float(args['--parallel-min']) * 1024 * 1024)
+
+    cfg.max_line = int(args['--max-line'])
+
+    cfg.split_marker = args['--split-marker']
+
+    cfg.index = args['--index']
+
+    cfg.styles = args['--styles']
+
+    cfg.html = args['--html']
+
+    if args['--cache']:
+        cfg.cache = ConversionCache(args['--cache'],
+                                    int(float(args['--cache-size']) * 1024 * 1024))
+
     cfg.command = args['<command>']
     cfg.argv = args['<argv>']
 
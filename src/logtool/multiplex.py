@@ -1,15 +1,330 @@
-from select import select
+import io
+import os
+import stat
+import errno
+import fcntl
+import ctypes
+import codecs
+import queue
+import select
+import selectors
+import tempfile
+import threading
 from subprocess import PIPE
 import sys
 from dataclasses import dataclass
+from functools import lru_cache
+from contextlib import contextmanager
 
-from .vendor.miniplumbum import (
-    ExecutionModifier,
-    read_fd_decode_safely,
-)
+from .vendor.miniplumbum import ExecutionModifier
 
 KEYBOARD_INTERRUPT_RETCODE = 7
 
+# Bytes first taken from a ready pipe at once.  A single os.read() returns
+# whatever is in the pipe, up to this, so small outputs are not delayed.
+READ_SIZE = 65536
+
+# Capacity the child's pipes are raised to, where the system allows.  Reads
+# of a pipe double while they fill up, as when the child writes continuously,
+# up to its capacity, and halve back to READ_SIZE while they come up short,
+# as for interactive output, so it is not read into needlessly large buffers.
+PIPE_SIZE = 1024 * 1024
+
+# Bytes read held for each output, the terminal and converters included,
+# until written, counted in bytes rather than reads, as these grow up to
+# PIPE_SIZE : 16 reads of the largest size, 256 of the smallest.
+QUEUE_SIZE = 16 * PIPE_SIZE
+
+# When the terminal or an output falls QUEUE_SIZE bytes behind : the
+# capture waits for it, and the child for the capture ('block'), the
+# terminal loses what does not fit, the others still getting it, while
+# outputs are waited for ('drop'), or it is held in a temporary file until
+# it catches up ('spill').  Converters are always waited for.
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+
+
+class _Writer(object):
+    """
+    A thread calling write(), and flush() if given, with each buffer put(),
+    in order, so a slow output does not hold up the capture.  The buffers
+    are queued, at most size bytes of them until written, beyond which
+    overflow applies.  A buffer larger than size is queued alone.
+    """
+
+    def __init__(self, name, write, flush=None, overflow='block', size=QUEUE_SIZE):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy : '%s'" % overflow)
+        self.name = name
+        self.write = write
+        self.flush = flush
+        self.overflow = overflow
+        self.queue = queue.Queue()
+        self.size = size
+        self.queued = 0
+        self.dropped = 0
+        self.error = None
+        # Spilled bytes, once any, go to the end of the spill until all are
+        # read back, as they follow those queued
+        self.lock = threading.Condition()
+        self.spill = None
+        self.spilled = 0
+        self.unspilled = 0
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, data):
+        with self.lock:
+            if self.overflow == 'block':
+                self.lock.wait_for(lambda: self._fits(data))
+            elif not self._fits(data) or self.spilled != self.unspilled:
+                if self.overflow == 'drop':
+                    self.dropped += len(data)
+                    return
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(self.spilled)
+                self.spill.write(data)
+                self.spilled += len(data)
+                return
+            self.queued += len(data)
+        self.queue.put(data)
+
+    def _fits(self, data):
+        return not self.queued or self.queued + len(data) <= self.size
+
+    def close(self):
+        """Wait until all is written, raising the first error of write()."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.spill is not None:
+            self.spill.close()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is not None:
+                self._write(data)
+                with self.lock:
+                    self.queued -= len(data)
+                    self.lock.notify()
+            if self.queue.empty():
+                self._unspill()
+            if data is None:
+                break
+
+    def _unspill(self):
+        while True:
+            with self.lock:
+                if self.spilled == self.unspilled:
+                    if self.spilled:
+                        self.spill.truncate(0)
+                        self.spilled = self.unspilled = 0
+                    return
+                self.spill.seek(self.unspilled)
+                data = self.spill.read(READ_SIZE)
+                self.unspilled += len(data)
+            self._write(data)
+
+    def _write(self, data):
+        # Once failed, the rest is discarded, so the capture is not held up
+        if self.error is not None:
+            return
+        try:
+            self.write(data)
+            if self.flush:
+                self.flush()
+        except Exception as e:
+            self.error = e
+
+
+# On Linux, with splice, the child's output is copied to the outputs with
+# tee(2), which the os module lacks, into a scratch pipe then splice(2) from
+# it, and moved to the terminal with splice(2), so it never enters Python.
+# Only regular files are spliced to.
+SPLICE_F_NONBLOCK = 2
+
+
+@lru_cache(maxsize=None)
+def _libc_tee():
+    """tee(2) from the C library, or None."""
+    try:
+        tee = ctypes.CDLL(None, use_errno=True).tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint)
+    tee.restype = ctypes.c_ssize_t
+    return tee
+
+
+def _tee(source, dest, size):
+    while True:
+        n = _libc_tee()(source, dest, size, SPLICE_F_NONBLOCK)
+        if n >= 0:
+            return n
+        error = ctypes.get_errno()
+        if error != errno.EINTR:
+            # BlockingIOError for EAGAIN
+            raise OSError(error, os.strerror(error))
+
+
+@contextmanager
+def _pidfd(pid):
+    """
+    A file descriptor readable once the process pid exits, closed on leaving,
+    or None where the system has no pidfds.
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        fd = None
+    try:
+        yield fd
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def _raise_pipe_size(fd, size=PIPE_SIZE):
+    """
+    Raise the capacity of the pipe fd to size, or as close to it as the
+    system allows.  Returns its capacity, READ_SIZE if unknown.
+    """
+    try:
+        capacity = fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+    except (AttributeError, OSError):
+        return READ_SIZE
+    while size > capacity:
+        try:
+            return fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            # Beyond the limit of the system, or of the user's pipes
+            size //= 2
+    return capacity
+
+
+def _next_read_size(size, read, capacity):
+    """The size of the next read of a pipe after read bytes of size."""
+    if read >= size:
+        return min(size * 2, capacity)
+    if read <= size // 4:
+        return max(size // 2, READ_SIZE)
+    return size
+
+
+def _splice_some(source, dest, size):
+    """
+    Move up to size bytes from the pipe source to dest.  The child's pipes
+    are non-blocking, which makes splice(2) from them non-blocking at both
+    ends, so a full pipe dest (stdout piped to a pager) is waited for here.
+    Raises BlockingIOError if source is empty.
+    """
+    while True:
+        try:
+            return os.splice(source, dest, size)
+        except BlockingIOError:
+            if select.select([], [dest], [], 0)[1]:
+                raise
+            select.select([], [dest], [])
+
+
+def _splice(source, dest, size):
+    """Move size bytes, all in the pipe source, to dest."""
+    while size:
+        size -= _splice_some(source, dest, size)
+
+
+class _Splicer(object):
+    """
+    Copies the data of the child's pipes to the outputs, and moves it to the
+    terminal, in the kernel.  See create().
+    """
+
+    def __init__(self, files, terminals):
+        self.files = files
+        self.terminals = terminals
+        # Terminals splice(2) cannot write to, written from Python instead
+        self.copied = set()
+        self.scratch = os.pipe() if files else None
+        if self.scratch:
+            _raise_pipe_size(self.scratch[1])
+
+    @classmethod
+    def create(cls, outputs, terminals):
+        """
+        A _Splicer copying to outputs, file objects, and moving to the text
+        streams of terminals, by child pipe, or None if either cannot be
+        spliced to here.
+        """
+        if not hasattr(os, 'splice') or (outputs and _libc_tee() is None):
+            return None
+        try:
+            fds = {fp: tee.fileno() for fp, tee in terminals.items()}
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+        if not all(stat.S_ISREG(os.fstat(fp.fileno()).st_mode) for fp in outputs):
+            return None
+        for fp in list(outputs) + list(terminals.values()):
+            fp.flush()
+        # splice(2) cannot write to files opened to append, which are at
+        # their end anyway
+        for fp in outputs:
+            fcntl.fcntl(fp, fcntl.F_SETFL, fcntl.fcntl(fp, fcntl.F_GETFL) & ~os.O_APPEND)
+        return cls([fp.fileno() for fp in outputs], fds)
+
+    def close(self):
+        if self.scratch:
+            for fd in self.scratch:
+                os.close(fd)
+            self.scratch = None
+
+    def move(self, fp, size=READ_SIZE):
+        """
+        Copy what is in the pipe fp, up to size bytes, to the outputs and
+        move it to its terminal.  Returns the number of bytes, 0 at EOF, or
+        raises BlockingIOError if there are none.
+        """
+        source = fp.fileno()
+        terminal = self.terminals[fp]
+        if self.files:
+            size = _tee(source, self.scratch[1], size)
+            if not size:
+                return 0
+            for n, dest in enumerate(self.files):
+                # Each tee(2) copies the same bytes, still in the pipe
+                if n:
+                    _tee(source, self.scratch[1], size)
+                _splice(self.scratch[0], dest, size)
+        if terminal not in self.copied:
+            try:
+                if not self.files:
+                    return _splice_some(source, terminal, size)
+                # All of what was copied to the outputs, and only it, as it
+                # is copied again from the pipe until moved out
+                _splice(source, terminal, size)
+                return size
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENXIO):
+                    raise
+                self.copied.add(terminal)
+        data = os.read(source, size)
+        with memoryview(data) as view:
+            written = 0
+            while written < len(data):
+                written += os.write(terminal, view[written:])
+        return len(data)
+
+
+def _echo(decoder, tee):
+    """Write the bytes given to tee, a text stream, decoded by decoder."""
+    def write(data):
+        text = decoder.decode(data)
+        if text:
+            tee.write(text)
+    return write
+
+
 class MULTIPLEX(ExecutionModifier):
     """Run a command, dumping its stdout/stderr to the current process's stdout
     and stderr, but ALSO return them.  Useful for interactive programs that
@@ -20,6 +335,23 @@ class MULTIPLEX(ExecutionModifier):
         ls["-l"] & MULTIPLEX(keep=False,'/dev/log-recorder'
              ,'/var/log/service/task.log')
 
+    Output is also fed, as it is captured, to each of `converters`, such as
+    a RawToText writing the plain-text log, by a thread of its own, so the
+    capture only waits for a converter once QUEUE_SIZE bytes behind.
+    They are not closed.  A converter failing does not stop the capture : it
+    is fed no more, and its error is kept in `converter_errors`, by
+    converter, rather than raised as those of the outputs are.
+
+    The outputs are written the bytes captured, unchanged.  Only the echo
+    to the terminal, and the output returned, are decoded, as UTF-8 with
+    replacement characters for invalid bytes.
+
+    The terminal and each output are written by a thread of their own, see
+    `overflow` and OVERFLOW_POLICIES for what happens when one falls behind.
+    With `splice`, on Linux, when there are no converters, nothing is kept,
+    `overflow` is 'block', the outputs are regular files and the terminal
+    has a file descriptor, the output is instead moved in the kernel.
+
     Returns a tuple of (return code, stdout, stderr), just like ``run()``.
     """
 
@@ -32,10 +364,15 @@ class MULTIPLEX(ExecutionModifier):
             keep = True,
             append = False,
             timeout = 15, # 60,
-            outputs = None):
+            outputs = None,
+            converters = None,
+            overflow = 'block',
+            splice = False):
         """`retcode` is the return code to expect to mean "success".  Set
         `buffered` to False to disable line-buffering the output, which may
         cause stdout and stderr to become more entangled than usual.
+        `overflow` is one of OVERFLOW_POLICIES.  Set `splice` to move the
+        output in the kernel where possible, see _Splicer.
 
         Default timeout 60 seconds (*** TODO: 7 during testing)
         """
@@ -45,6 +382,12 @@ class MULTIPLEX(ExecutionModifier):
         self.append = append
         self.timeout = timeout
         self.outputs = outputs or []
+        self.converters = converters or []
+        self.converter_errors = {}
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy : '%s'" % overflow)
+        self.overflow = overflow
+        self.splice = splice
         # print(f"[m] {outputs = }")
 
     def __rand__(self, cmd):
@@ -61,7 +404,7 @@ class MULTIPLEX(ExecutionModifier):
             outbuf = []
             errbuf = []
 
-            mode = 'a' if self.append else 'w'
+            mode = 'ab' if self.append else 'wb'
 
             @dataclass
             class MultiplexIO:
@@ -71,57 +414,165 @@ class MULTIPLEX(ExecutionModifier):
                 err = bg.stderr
                 mout = [open(path, mode) for path in self.outputs]
                 tee_to = {out: sys.stdout, err: sys.stderr}
+                # Characters split across reads are held until complete
+                decoders = {fp: codecs.getincrementaldecoder('utf-8')('replace')
+                            for fp in (out, err)}
                 buffers = {}
+                writers = {}
+                splicer = None
 
             mio = MultiplexIO()
 
             if self.keep:
                 mio.buffers = {mio.out: outbuf, mio.err: errbuf}
 
+            def writer(name, write, fp, overflow):
+                return _Writer(name, write, None if self.buffered else fp.flush,
+                               overflow)
+
+            # Only the terminal may lose output, the log is written whole
+            overflow = 'block' if self.overflow == 'drop' else self.overflow
+            outputs = [writer(fp.name, fp.write, fp, overflow) for fp in mio.mout]
+            echoes = [writer(getattr(tee, 'name', 'terminal'),
+                             _echo(mio.decoders[fp], tee), tee, self.overflow)
+                      for fp, tee in mio.tee_to.items()]
+            # Fed in turn, as they are slower than the capture
+            feeders = [_Writer(type(converter).__name__, converter.feed)
+                       for converter in self.converters]
+            for fp, echo in zip(mio.tee_to, echoes):
+                mio.writers[fp] = [echo] + outputs + feeders
+
+            # Moved in the kernel when nothing else needs to see the bytes
+            if (self.splice and not self.keep and not self.converters
+                    and self.overflow == 'block'):
+                mio.splicer = _Splicer.create(mio.mout, mio.tee_to)
+
             try:
                 self.rand_core(bg, mio)
             except KeyboardInterrupt:
                 print("*** KeyboardInterrupt")
                 bg.returncode = KEYBOARD_INTERRUPT_RETCODE
-
-            for fp_list in [ mio.mout, mio.tee_to.values() ]:
-                for fp in fp_list :
+            finally:
+                if mio.splicer:
+                    mio.splicer.close()
+                errors = []
+                for writer in echoes + outputs:
+                    try:
+                        writer.close()
+                    except Exception as e:
+                        errors.append(e)
+                    if writer.dropped:
+                        print("*** %d bytes not written to %s, which fell behind"
+                              % (writer.dropped, writer.name), file=sys.stderr)
+                for converter, feeder in zip(self.converters, feeders):
+                    try:
+                        feeder.close()
+                    except Exception as e:
+                        self.converter_errors[converter] = e
+                for fp, decoder in mio.decoders.items():
+                    mio.tee_to[fp].write(decoder.decode(b'', final=True))
+                for fp in mio.mout:
+                    fp.close()
+                for fp in mio.tee_to.values():
                     fp.flush()
-	                
-            stdout = ''.join([buf.decode('utf-8')
-                              for buf in outbuf]) if self.keep else ''
+                if errors:
+                    raise errors[0]
+
+            stdout = b''.join(outbuf).decode('utf-8', 'replace') if self.keep else ''
 
-            stderr = ''.join([buf.decode('utf-8')
-                              for buf in errbuf]) if self.keep else ''
+            stderr = b''.join(errbuf).decode('utf-8', 'replace') if self.keep else ''
 
             return bg.returncode, stdout, stderr
 
     def rand_core(self, bg, mio):
-            while bg.poll() is None:
-                ready, _, _ = select((mio.in_r, mio.out, mio.err), (), (), self.timeout)
-                for fd in ready:
-                    data, text = read_fd_decode_safely(fd, 4096)
-                    if not data and not text:
+        """
+        Copy the child's output to the outputs, and our stdin to the child,
+        until the child closes both its stdout and stderr, or has exited and
+        nothing more is in them, then wait for it.  Where the system has
+        pidfds, the child's exit is watched along with the pipes, otherwise
+        it is checked after `timeout` seconds without output.  The pipes are
+        registered once with a selector (epoll on Linux) and read, bypassing
+        their buffered file objects, with a single os.read() of the raw
+        descriptor when ready, of a size following the flow of output, see
+        PIPE_SIZE.  The child's pipes are non-blocking, so a spurious wakeup
+        never stalls the loop.
+        """
+        with selectors.DefaultSelector() as selector, _pidfd(bg.proc.pid) as pidfd:
+            capacities = {}
+            for fp in (mio.out, mio.err):
+                os.set_blocking(fp.fileno(), False)
+                capacities[fp] = _raise_pipe_size(fp.fileno())
+                selector.register(fp, selectors.EVENT_READ)
+            sizes = dict.fromkeys(capacities, READ_SIZE)
+            # Left blocking, it is shared with the invoking shell
+            in_file = None
+            try:
+                selector.register(mio.in_r, selectors.EVENT_READ)
+            except PermissionError:
+                # A regular file, or /dev/null, which epoll refuses, is
+                # always ready, so is read without waiting for it
+                in_file = selectors.SelectorKey(mio.in_r, mio.in_r.fileno(),
+                                                selectors.EVENT_READ, None)
+            if pidfd is not None:
+                selector.register(pidfd, selectors.EVENT_READ)
+            exited = False
+            outputs = 2
+            while outputs:
+                # Once the child has exited, what is in the pipes is read,
+                # but output left to others holding them is not waited for
+                ready = selector.select(0 if in_file or exited else self.timeout)
+                if not ready and (exited or bg.poll() is not None):
+                    break
+                if in_file:
+                    ready.append((in_file, selectors.EVENT_READ))
+                for key, _ in ready:
+                    fd = key.fileobj
+                    if fd == pidfd:
+                        selector.unregister(pidfd)
+                        exited = True
+                        continue
+                    size = sizes.get(fd, READ_SIZE)
+                    try:
+                        if mio.splicer and fd != mio.in_r:
+                            moved = mio.splicer.move(fd, size)
+                            if moved:
+                                sizes[fd] = _next_read_size(size, moved, capacities[fd])
+                                continue
+                            data = b''
+                        else:
+                            data = os.read(key.fd, size)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        if fd != mio.in_r:
+                            selector.unregister(fd)
+                            outputs -= 1
+                            continue
+                        # Stdin at EOF stays ready, it is no longer watched
+                        # and the EOF is passed on to the child
+                        if key is in_file:
+                            in_file = None
+                        else:
+                            selector.unregister(fd)
+                        try:
+                            mio.in_w.close()
+                        except BrokenPipeError:
+                            pass
                         continue
                     # print(f"{len(data) = }, {len(text) = }")
                     # Python conveniently line-buffers stdout and stderr for
                     # us, so all we need to do is write to them.
-                    # This will automatically add up to three bytes if it
-                    # cannot be decoded ? (BOM)
                     if fd == mio.in_r:
                         mio.in_w.write(data)
                         if not self.buffered:
                             mio.in_w.flush()
                     else:
-                        mio.tee_to[fd].write(text)
-                        for fout in mio.mout:
-                            fout.write(text)
+                        sizes[fd] = _next_read_size(size, len(data), capacities[fd])
                         # And then "unbuffered" is just flushing after each
-                        # write
-                        if not self.buffered:
-                            mio.tee_to[fd].flush()
-                            for fout in mio.mout:
-                                fout.flush()
+                        # write, by the writers
+                        for writer in mio.writers[fd]:
+                            writer.put(data)
                         if self.keep:
                             mio.buffers[fd].append(data)
+        bg.wait()
                 
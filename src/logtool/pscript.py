@@ -16,6 +16,24 @@ Options:
   -t, --time              Prefix each line with elapsed time
   -w, --wallclock         Prefix each line with local time of day
   -x, --show              Show the command line to be exectuted.
+  -T, --text <text-file>  Also convert the output to plain text, as it is
+                          captured, into <text-file>
+  --max-line <n>          Split text lines longer than <n> characters, 0 for
+                          no limit [default: 0]
+  --split-marker <text>   Text ending each piece of a split line [default: ]
+  --index <index-file>    Also write the line index of <text-file>, the
+                          offsets of each line in it and in <file>
+  --styles <styles-file>  Also write the style table of <text-file>, the
+                          colors and styles of its text
+  --checkpoint <ckpt-file>  Write the final state of the conversion to
+                          <text-file>, as JSON, to <ckpt-file>
+  --overflow <policy>     When the terminal or <file> falls behind the
+                          output, block the command, drop what the terminal
+                          cannot take, still writing <file> whole, or spill
+                          it to a temporary file until it catches up : block,
+                          drop or spill [default: block]
+  --splice                On Linux, move the output to the terminal and
+                          <file> in the kernel, unless it is converted
   -V, --version           Output version information and exit
   -h, --help              Display this help and exit
  """
@@ -27,6 +45,7 @@ Options:
 
 import sys
 import os
+import json
 import time
 
 import shlex
@@ -39,6 +58,8 @@ from logtool import __version__ as version
 
 from logtool.multiplex import MULTIPLEX
 
+from .vendor.raw_to_text import RawToText
+
 from prettyprinter import cpprint as pp
 
 ttee = local['ttee']
@@ -90,7 +111,9 @@ class ActionConfig (object):
     __slots__ = ('args', 'filename', 'append', 'mode', 
                  'command_string', 'command', 'argv',
                  'return_', 'python', 'show', 'quiet',
-                 'verbose', 'debug')
+                 'verbose', 'debug', 'text', 'max_line', 'split_marker',
+                 'index', 'styles', 'checkpoint', 'overflow',
+                 'splice', 'conversion_error')
 
 
 def configure(args):
@@ -100,6 +123,14 @@ def configure(args):
     cfg.command = None
     cfg.argv = []
     cfg.filename = args['<file>']
+    cfg.text = args['--text']
+    cfg.max_line = int(args['--max-line'])
+    cfg.split_marker = args['--split-marker']
+    cfg.index = args['--index']
+    cfg.styles = args['--styles']
+    cfg.checkpoint = args['--checkpoint']
+    cfg.overflow = args['--overflow']
+    cfg.splice = args['--splice']
     cfg.append = args['--append']
     cfg.return_ = args['--return']
     cfg.show = args['--show']
@@ -170,6 +201,58 @@ def configure(args):
 
 def perform(cfg):
 
+    # Plain-text log, converted as the output is captured
+    text_fp = open(cfg.text, cfg.mode) if cfg.text else None
+    index_fp = open(cfg.index, cfg.mode) if text_fp and cfg.index else None
+    styles_fp = open(cfg.styles, cfg.mode) if text_fp and cfg.styles else None
+    converter = None
+    if text_fp:
+        # Output appended to earlier output, converted separately
+        raw_offset = 0
+        if cfg.append and cfg.filename and os.path.exists(cfg.filename):
+            raw_offset = os.path.getsize(cfg.filename)
+        converter = RawToText(text_fp, max_line=cfg.max_line,
+                              split_marker=cfg.split_marker, index=index_fp,
+                              raw_offset=raw_offset, text_offset=text_fp.tell(),
+                              styles=styles_fp)
+
+    # A conversion failing leaves the capture, and the raw log, unaffected.
+    # Its text is then incomplete, and no checkpoint is written.
+    cfg.conversion_error = None
+    try:
+        return perform_with(cfg, converter)
+    finally:
+        if converter:
+            if cfg.conversion_error is None:
+                try:
+                    checkpoint = converter.checkpoint()
+                    converter.close()
+                except Exception as e:
+                    cfg.conversion_error = e
+            text_fp.close()
+            if cfg.conversion_error is not None:
+                print("*** raw to text conversion failed : %s" % cfg.conversion_error,
+                      file=sys.stderr)
+            elif cfg.checkpoint:
+                with open(cfg.checkpoint, 'w') as f:
+                    json.dump(checkpoint, f)
+        if index_fp:
+            index_fp.close()
+        if styles_fp:
+            styles_fp.close()
+
+
+def feed(cfg, converter, data):
+    """Feed data to converter, if any, unless it has failed, see perform()."""
+    if converter and cfg.conversion_error is None:
+        try:
+            converter.feed(data)
+        except Exception as e:
+            cfg.conversion_error = e
+
+
+def perform_with(cfg, converter):
+
     file_info = ''
 
     if not cfg.quiet:
@@ -178,16 +261,20 @@ def perform(cfg):
         print(f'Script started{file_info}')
         sys.stdout.flush()
         if cfg.filename:
+            message = ('Script started at %s\n' % time.asctime()).encode()
             with open(cfg.filename, cfg.mode) as f:
-                f.write(('Script started at %s\n' % time.asctime()).encode())
+                f.write(message)
+            feed(cfg, converter, message)
             cfg.mode = 'ab'
 
     if cfg.show:
         print(f'+ {cfg.command_string}')
         sys.stdout.flush()
         if cfg.filename:
+            message = f'+ {cfg.command_string}\n'.encode()
             with open(cfg.filename, cfg.mode) as f:
-                f.write(f'+ {cfg.command_string}\n'.encode())
+                f.write(message)
+            feed(cfg, converter, message)
             cfg.mode = 'ab'
 
     try:
@@ -200,7 +287,15 @@ def perform(cfg):
             chain |= ttee['-uxt']
         append = cfg.mode != 'w'
         outputs = [cfg.filename] if cfg.filename else []
-        chain & MULTIPLEX(append=append, outputs=outputs, keep=False)
+        converters = [converter] if converter else []
+        multiplex = MULTIPLEX(append=append, outputs=outputs, keep=False,
+                              converters=converters, overflow=cfg.overflow,
+                              splice=cfg.splice)
+        try:
+            chain & multiplex
+        finally:
+            if converter in multiplex.converter_errors:
+                cfg.conversion_error = multiplex.converter_errors[converter]
         # , buffered=False)
     except ProcessExecutionError as e:
         print(e.stdout)
@@ -211,8 +306,10 @@ def perform(cfg):
     if not cfg.quiet:
         # script.write(('Script done at %s\n' % time.asctime()).encode())
         if cfg.filename:
+            message = ('Script done on %s\n' % time.asctime()).encode()
             with open(cfg.filename, 'ab') as f:
-                f.write(('Script done on %s\n' % time.asctime()).encode())
+                f.write(message)
+            feed(cfg, converter, message)
         print(f'Script done{file_info}')
         sys.stdout.flush()
 
@@ -0,0 +1,82 @@
+import os
+import json
+
+from logtool.cache import ConversionCache, raw_to_text_cached
+from logtool.vendor import raw_to_text as rtt
+
+
+RAW = b"first\nprogress 10%\rprogress 100%\n\x1b[1msecond\x1b[0m\n"
+TEXT = b"first\nprogress 100%\nsecond\n"
+
+
+def test_cache_hit(tmp_path, monkeypatch):
+    """A conversion of the same raw output is copied from the cache."""
+    cache = ConversionCache(str(tmp_path / 'cache'))
+    raw_file = tmp_path / 'raw.dat'
+    raw_file.write_bytes(RAW)
+    checkpoint = raw_to_text_cached(cache, str(raw_file), str(tmp_path / 'one.txt'),
+                                    index_file=str(tmp_path / 'one.idx'))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("converted again")
+    monkeypatch.setattr("logtool.cache.raw_to_text_mmap", fail)
+
+    assert raw_to_text_cached(cache, str(raw_file), str(tmp_path / 'two.txt'),
+                              index_file=str(tmp_path / 'two.idx')) == checkpoint
+    assert (tmp_path / 'two.txt').read_bytes() == TEXT
+    assert (tmp_path / 'two.idx').read_bytes() == (tmp_path / 'one.idx').read_bytes()
+    assert json.loads(json.dumps(checkpoint)) == checkpoint
+
+    # Other options or output are other conversions
+    monkeypatch.setattr("logtool.cache.raw_to_text_mmap", rtt.raw_to_text_mmap)
+    raw_to_text_cached(cache, str(raw_file), str(tmp_path / 'three.txt'), max_line=8)
+    assert (tmp_path / 'three.txt').read_bytes() != TEXT
+    raw_file.write_bytes(RAW + b"third\n")
+    raw_to_text_cached(cache, str(raw_file), str(tmp_path / 'four.txt'))
+    assert (tmp_path / 'four.txt').read_bytes() == TEXT + b"third\n"
+
+
+def test_cache_link(tmp_path):
+    """Hits are hard linked, and a linked file changed since is a miss."""
+    cache = ConversionCache(str(tmp_path / 'cache'))
+    raw_file = str(tmp_path / 'raw.dat')
+    with open(raw_file, 'wb') as f:
+        f.write(RAW)
+    one, two = str(tmp_path / 'one.txt'), str(tmp_path / 'two.txt')
+    raw_to_text_cached(cache, raw_file, one, link=True)
+    raw_to_text_cached(cache, raw_file, two, link=True)
+    assert os.path.samefile(one, two)
+
+    with open(two, 'ab') as f:
+        f.write(b"appended\n")
+    three = str(tmp_path / 'three.txt')
+    raw_to_text_cached(cache, raw_file, three)
+    with open(three, 'rb') as f:
+        assert f.read() == TEXT
+
+
+def test_cache_eviction(tmp_path):
+    """The least recently used conversions go once over the cache size."""
+    cache = ConversionCache(str(tmp_path / 'cache'), size=4000)
+    raws = []
+    for n in range(4):
+        raw_file = str(tmp_path / ('raw%d.dat' % n))
+        with open(raw_file, 'wb') as f:
+            f.write(b"%d\n" % n * 500)
+        raws.append(raw_file)
+    out = str(tmp_path / 'out.txt')
+
+    for raw_file in raws[:3]:
+        raw_to_text_cached(cache, raw_file, out)
+    # Using the first makes the second the least recently used
+    keys = []
+    for raw_file in raws:
+        with open(raw_file, 'rb') as f:
+            keys.append(cache.key(f, max_line=0, split_marker='', files=['text']))
+    for n in range(3):
+        os.utime(cache.path(keys[n], '.json'), ns=(0, n * 10**9))
+    assert cache.fetch(keys[0], text=out) is not None
+
+    raw_to_text_cached(cache, raw_file, out)
+    assert sum(size for _, size, _ in cache.entries()) <= 4000
+    assert [cache.fetch(key, text=out) is not None for key in keys] == [True, False, True, True]
@@ -2,6 +2,9 @@ import unittest
 import tempfile
 import os
 
+from logtool.log import convert_appended, read_checkpoint, write_checkpoint
+from logtool.vendor.raw_to_text import index_entry, raw_to_text_mmap, read_styles
+
 from tests.common import LogTool_TestCase
 
 #------------------------------------------------------------------------------
@@ -18,3 +21,148 @@ class Test_Case ( LogTool_TestCase ) :
         self.log_common ( 'log', raw = True )
 
 #
+
+#------------------------------------------------------------------------------
+
+def test_convert_appended(tmp_path):
+    """Appended output is converted from the checkpoint, and only it."""
+    logfile = str(tmp_path / 'append.log')
+    raw_file = logfile + '.raw'
+    txt_file = logfile + '.txt'
+
+    with open(logfile, 'wb') as f:
+        f.write(b"first\nprogress 10%")
+    with open(logfile, 'rb') as in_f, open(txt_file, 'wb') as out_f:
+        checkpoint = raw_to_text_mmap(in_f, out_f)
+    os.rename(logfile, raw_file)
+    os.rename(txt_file, logfile)
+    write_checkpoint(logfile, checkpoint)
+
+    assert read_checkpoint(logfile + '.missing') is None
+    checkpoint = read_checkpoint(logfile)
+
+    with open(logfile, 'ab') as f:
+        f.write(b"\rprogress 100%\n\x1b[1msecond\x1b[0m\n")
+
+    # Invalidated by the append
+    assert read_checkpoint(logfile) is None
+    checkpoint = convert_appended(logfile, raw_file, txt_file, checkpoint)
+    write_checkpoint(logfile, checkpoint)
+
+    with open(logfile, 'rb') as f:
+        assert f.read() == b"first\nprogress 100%\nsecond\n"
+    with open(raw_file, 'rb') as f:
+        assert f.read() == (b"first\nprogress 10%"
+                            b"\rprogress 100%\n\x1b[1msecond\x1b[0m\n")
+    assert read_checkpoint(logfile)['converter']['at_rest']
+
+
+def test_convert_appended_index(tmp_path):
+    """The line index and style table are continued with the appended output."""
+    logfile = str(tmp_path / 'append.log')
+    raw_file = logfile + '.raw'
+    txt_file = logfile + '.txt'
+    indexfile = logfile + '.idx'
+    stylesfile = logfile + '.sty'
+
+    with open(logfile, 'wb') as f:
+        f.write(b"\x1b[1mfirst\x1b[0m\nprogress 10%")
+    with open(logfile, 'rb') as in_f, open(txt_file, 'wb') as out_f, \
+            open(indexfile, 'wb') as index, open(stylesfile, 'wb') as styles:
+        checkpoint = raw_to_text_mmap(in_f, out_f, index=index, styles=styles)
+    os.rename(logfile, raw_file)
+    os.rename(txt_file, logfile)
+    write_checkpoint(logfile, checkpoint)
+
+    checkpoint = read_checkpoint(logfile)
+    with open(logfile, 'ab') as f:
+        f.write(b"\rprogress 100%\n\x1b[1msecond\x1b[0m\n")
+    convert_appended(logfile, raw_file, txt_file, checkpoint, indexfile=indexfile,
+                     stylesfile=stylesfile)
+
+    with open(indexfile, 'rb') as index:
+        assert [index_entry(index, n) for n in range(4)] == [
+            (0, 0), (14, 6), (41, 20), (56, 27)]
+    with open(stylesfile, 'rb') as styles:
+        assert [run[:2] for run in read_styles(styles)] == [(0, 5), (20, 6)]
+
+
+def test_convert_appended_styles(tmp_path):
+    """The style of the partial last line is not recorded twice."""
+    logfile = str(tmp_path / 'append.log')
+    raw_file = logfile + '.raw'
+    txt_file = logfile + '.txt'
+    stylesfile = logfile + '.sty'
+
+    with open(logfile, 'wb') as f:
+        f.write(b"first\n\x1b[1mbol")
+    with open(logfile, 'rb') as in_f, open(txt_file, 'wb') as out_f, \
+            open(stylesfile, 'wb') as styles:
+        checkpoint = raw_to_text_mmap(in_f, out_f, styles=styles)
+    os.rename(logfile, raw_file)
+    os.rename(txt_file, logfile)
+    write_checkpoint(logfile, checkpoint)
+
+    checkpoint = read_checkpoint(logfile)
+    with open(logfile, 'ab') as f:
+        f.write(b"d\x1b[0m\n")
+    convert_appended(logfile, raw_file, txt_file, checkpoint, stylesfile=stylesfile)
+
+    with open(stylesfile, 'rb') as styles:
+        assert [run[:2] for run in read_styles(styles)] == [(6, 4)]
+
+
+def test_log_cache(tmp_path, monkeypatch):
+    """With a cache, the log is converted after the command, through it."""
+    from logtool import log, cache
+    from tests.common import redirect_stdin, empty_pipe
+
+    for n in range(2):
+        logfile = str(tmp_path / ('cached%d.log' % n))
+        with redirect_stdin(empty_pipe()):
+            log.main(['log', '--cache', str(tmp_path / 'cache'), '-q', '-x',
+                      logfile, 'echo', 'cached'])
+        with open(logfile, 'rb') as f:
+            assert f.read() == b'\ncached\n\n'
+        # The second conversion is a hit
+        monkeypatch.setattr(cache, 'raw_to_text_mmap', None)
+    assert read_checkpoint(logfile)['converter']['at_rest']
+
+
+def test_log_show_max_line(tmp_path):
+    """The command line logged is split at --max-line, as the output is."""
+    from logtool import log
+    from tests.common import redirect_stdin, empty_pipe
+
+    logfile = str(tmp_path / 'split.log')
+    with redirect_stdin(empty_pipe()):
+        log.main(['log', '--max-line', '8', '--split-marker=\\', '-q', logfile,
+                  'echo', 'abcdefghijklmnop'])
+    with open(logfile, 'rb') as f:
+        lines = f.read().splitlines()
+    assert lines[:2] == [b'+ echo a\\', b'bcdefghi\\']
+    assert max(len(line) for line in lines) <= 9
+
+
+def test_log_failing_converter(tmp_path, monkeypatch, capsys):
+    """A live conversion failing leaves the capture whole, and the log is
+    converted again after the command, which still returns normally."""
+    from logtool import log, pscript
+    from logtool.vendor.raw_to_text import RawToText
+    from tests.common import redirect_stdin, empty_pipe
+
+    class FailingConverter(RawToText):
+        def feed(self, data):
+            raise ValueError("broken converter")
+    monkeypatch.setattr(pscript, 'RawToText', FailingConverter)
+
+    logfile = str(tmp_path / 'failing.log')
+    with redirect_stdin(empty_pipe()):
+        retcode = log.main(['log', '-q', '-x', logfile, 'echo', 'converted'])
+    assert retcode == 0
+    assert "broken converter" in capsys.readouterr().err
+    with open(logfile, 'rb') as f:
+        assert f.read() == b'\nconverted\n\n'
+    assert os.path.exists(logfile + '.raw')
+    assert not os.path.exists(logfile + '.ckpt.tmp')
+    assert read_checkpoint(logfile)['converter']['at_rest']
@@ -55,3 +55,69 @@ class Test_Case ( LogTool_TestCase ) :
         self.assertTrue(os.path.isfile(file), f"{what} file '{file}' is not a regular file")
 
 #------------------------------------------------------------------------------
+
+def test_logts_cache(tmp_path):
+    """Output converted once is linked from the cache when converted again."""
+    from logtool import logts
+    from tests.common import redirect_stdin, empty_pipe
+
+    cache = tmp_path / 'cache'
+    texts = []
+    for n, stamp in enumerate((1704103200, 1704103201)):
+        ref = tmp_path / ('ref%d' % n)
+        ref.touch()
+        os.utime(ref, (stamp, stamp))
+        with redirect_stdin(empty_pipe()):
+            logts.main(['logts', '--base', str(tmp_path / 'logs'), '--ref', str(ref),
+                        '--cache', str(cache), '--index', '-q', '-n',
+                        'echo', 'cached'])
+        texts.extend((tmp_path / 'logs').glob('*/*/out.txt'))
+
+    texts = sorted(set(texts))
+    assert len(texts) == 2
+    assert texts[0].read_bytes() == b'\ncached\n\n'
+    assert os.path.samefile(texts[0], texts[1])
+    assert os.path.exists(texts[1].with_suffix('.idx'))
+    assert any(name.endswith('.json') for name in os.listdir(cache))
+
+
+def test_logts_jobs(tmp_path, monkeypatch):
+    """With --jobs, raw.dat is converted after the command, in parallel."""
+    from logtool import logts, cache
+    from tests.common import redirect_stdin, empty_pipe
+
+    calls = []
+    convert = cache.raw_to_text_mmap
+
+    def record(*args, **kwargs):
+        calls.append((kwargs['jobs'], kwargs['parallel_threshold']))
+        return convert(*args, **kwargs)
+    monkeypatch.setattr(cache, 'raw_to_text_mmap', record)
+
+    with redirect_stdin(empty_pipe()):
+        logts.main(['logts', '--base', str(tmp_path / 'logs'), '--jobs', '2',
+                    '--parallel-min', '0', '-q', '-n', 'echo', 'parallel'])
+
+    assert calls == [(2, 0)]
+    [text] = (tmp_path / 'logs').glob('*/*/out.txt')
+    assert text.read_bytes() == b'\nparallel\n\n'
+
+
+def test_logts_failing_converter(tmp_path, monkeypatch):
+    """out.txt is converted again from raw.dat when the live conversion fails."""
+    from logtool import logts, pscript
+    from logtool.vendor.raw_to_text import RawToText
+    from tests.common import redirect_stdin, empty_pipe
+
+    class FailingConverter(RawToText):
+        def feed(self, data):
+            raise ValueError("broken converter")
+    monkeypatch.setattr(pscript, 'RawToText', FailingConverter)
+
+    with redirect_stdin(empty_pipe()):
+        logts.main(['logts', '--base', str(tmp_path / 'logs'), '-q', '-n',
+                    'echo', 'converted'])
+
+    [text] = (tmp_path / 'logs').glob('*/*/out.txt')
+    assert text.read_bytes() == b'\nconverted\n\n'
+    assert not list((tmp_path / 'logs').glob('*/*/*.tmp'))
@@ -2,6 +2,8 @@ import sys
 import os
 import io
 import subprocess
+import threading
+import time
 
 import pytest
 
@@ -9,7 +11,9 @@ from unittest.mock import MagicMock, patch, mock_open
 
 from logtool.vendor.miniplumbum import local
 
-from logtool.multiplex import MULTIPLEX, KEYBOARD_INTERRUPT_RETCODE
+from logtool.multiplex import MULTIPLEX, KEYBOARD_INTERRUPT_RETCODE, _Writer, _Splicer
+from logtool.multiplex import READ_SIZE, PIPE_SIZE, _raise_pipe_size, _next_read_size
+from logtool.multiplex import QUEUE_SIZE
 
 from .common import redirect_stdin, empty_pipe
 
@@ -66,3 +70,405 @@ def test_multiplex_keyboard_interrupt():
         assert stderr == ""
         assert return_code == KEYBOARD_INTERRUPT_RETCODE
 
+
+
+def test_multiplex_large_output():
+    """All of a large output is captured, however fast it is written."""
+
+    with redirect_stdin(empty_pipe()):
+        yes = local['/bin/sh']['-c', 'yes 0123456789abcdef | head -c 4000000']
+        (return_code, stdout, stderr) = yes & MULTIPLEX(timeout=None)
+
+    assert len(stdout) == 4000000
+    assert stdout == "0123456789abcdef\n" * (4000000 // 17) + "0123456789abcdef"[:4000000 % 17]
+    assert return_code == 0
+
+
+
+def test_multiplex_stdin_eof():
+    """Stdin at EOF is passed on to the child, and not polled any more."""
+
+    with redirect_stdin(empty_pipe()):
+        start = time.process_time()
+        (return_code, stdout, stderr) = local['/bin/sleep']['1'] & MULTIPLEX()
+        cpu = time.process_time() - start
+        (return_code, stdout, stderr) = local['/bin/cat'] & MULTIPLEX()
+
+    assert cpu < 0.5
+    assert stdout == ""
+    assert return_code == 0
+
+
+def test_multiplex_stdin_file(tmp_path):
+    """A regular file as stdin, which cannot be polled, is forwarded whole."""
+
+    stdin_name = tmp_path / 'stdin.txt'
+    stdin_name.write_text("first\nsecond\n")
+
+    with open(stdin_name, 'r') as stdin:
+        with redirect_stdin(stdin):
+            (return_code, stdout, stderr) = local['/bin/cat'] & MULTIPLEX()
+
+    assert stdout == "first\nsecond\n"
+    assert return_code == 0
+
+
+def test_multiplex_binary_outputs(tmp_path):
+    """Outputs get the bytes unchanged, the terminal whole characters."""
+
+    out_name = tmp_path / 'out.dat'
+    script = r"printf 'caf\303'; sleep 0.2; printf '\251 \377\n'"
+    terminal = io.StringIO()
+
+    with redirect_stdin(empty_pipe()):
+        with patch('sys.stdout', terminal):
+            (return_code, stdout, stderr) = (local['/bin/sh']['-c', script]
+                                             & MULTIPLEX(outputs=[str(out_name)]))
+
+    assert out_name.read_bytes() == b"caf\xc3\xa9 \xff\n"
+    assert stdout == "café �\n"
+    assert terminal.getvalue() == "café �\n"
+    assert return_code == 0
+
+
+def test_multiplex_child_exit():
+    """Output left in the pipes is read, but others holding them are not
+    waited for once the child exits."""
+
+    # The sleep keeps the pipes open, but for the child's exit the capture
+    # would wait out its 15 s timeout
+    script = "sleep 5 & head -c 1000000 /dev/zero | tr '\\0' x"
+
+    start = time.monotonic()
+    with redirect_stdin(empty_pipe()):
+        with patch('sys.stdout', io.StringIO()):
+            (return_code, stdout, stderr) = (local['/bin/sh']['-c', script]
+                                             & MULTIPLEX(timeout=15))
+
+    assert time.monotonic() - start < 4
+    assert stdout == 'x' * 1000000
+    assert return_code == 0
+
+
+def test_read_size():
+    """Reads grow while they fill up, to the capacity, and shrink back."""
+    size = READ_SIZE
+    for _ in range(10):
+        size = _next_read_size(size, size, 4 * READ_SIZE)
+    assert size == 4 * READ_SIZE
+    assert _next_read_size(size, size // 2, 4 * READ_SIZE) == size
+    for _ in range(10):
+        size = _next_read_size(size, 1, 4 * READ_SIZE)
+    assert size == READ_SIZE
+
+
+def test_raise_pipe_size():
+    """A pipe is raised to PIPE_SIZE, or as close as the system allows."""
+    r, w = os.pipe()
+    try:
+        capacity = _raise_pipe_size(w)
+        assert READ_SIZE <= capacity <= PIPE_SIZE
+        # What a pipe holds is what a read gets
+        os.set_blocking(w, False)
+        written = 0
+        try:
+            while True:
+                written += os.write(w, b'x' * 65536)
+        except BlockingIOError:
+            pass
+        assert written == capacity or capacity == READ_SIZE
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+splice_only = pytest.mark.skipif(not hasattr(os, 'splice'), reason="no splice(2)")
+
+
+@splice_only
+@pytest.mark.parametrize('outputs', [0, 1, 2])
+def test_multiplex_splice(tmp_path, outputs):
+    """Spliced output reaches the terminal and outputs, appended to, whole."""
+
+    out_names = [tmp_path / ('out%d.dat' % n) for n in range(outputs)]
+    for out_name in out_names:
+        out_name.write_bytes(b"before\n")
+    script = r"head -c 1000000 /dev/urandom | od -An -tx1; printf 'caf\303'"
+
+    with redirect_stdin(empty_pipe()), open(tmp_path / 'terminal', 'w+') as terminal:
+        with patch('sys.stdout', terminal):
+            (return_code, stdout, stderr) = (
+                local['/bin/sh']['-c', script]
+                & MULTIPLEX(outputs=[str(name) for name in out_names], append=True,
+                            keep=False, splice=True))
+        terminal.seek(0)
+        echoed = terminal.buffer.read()
+
+    assert return_code == 0
+    assert len(echoed) > 1000000 and echoed.endswith(b"caf\xc3")
+    for out_name in out_names:
+        assert out_name.read_bytes() == b"before\n" + echoed
+
+
+@splice_only
+def test_multiplex_splice_fallback(tmp_path):
+    """Without a terminal file descriptor, output goes through Python."""
+
+    out_name = tmp_path / 'out.dat'
+    terminal = io.StringIO()
+    assert _Splicer.create([], {None: terminal}) is None
+
+    with redirect_stdin(empty_pipe()):
+        with patch('sys.stdout', terminal):
+            (return_code, stdout, stderr) = (local['/bin/echo']['spliced ?']
+                                             & MULTIPLEX(outputs=[str(out_name)],
+                                                         keep=False, splice=True))
+
+    assert terminal.getvalue() == "spliced ?\n"
+    assert out_name.read_bytes() == b"spliced ?\n"
+    assert return_code == 0
+
+
+@splice_only
+@pytest.mark.parametrize('outputs', [0, 1, 2])
+def test_multiplex_splice_slow_pipe(tmp_path, outputs):
+    """A terminal which is a pipe read slowly is waited for, spliced to, and
+    the outputs get each byte once."""
+
+    out_names = [tmp_path / ('out%d.dat' % n) for n in range(outputs)]
+    read_fd, write_fd = os.pipe()
+    received = []
+
+    def read_slowly():
+        while True:
+            data = os.read(read_fd, 16384)
+            if not data:
+                break
+            received.append(data)
+            time.sleep(0.01)
+    reader = threading.Thread(target=read_slowly)
+    reader.start()
+
+    expected = b"".join(b"line %d\n" % n for n in range(1, 300001))
+    start = time.process_time()
+    with redirect_stdin(empty_pipe()), open(write_fd, 'w') as terminal:
+        with patch('sys.stdout', terminal):
+            (return_code, stdout, stderr) = (
+                local['/bin/sh']['-c', 'seq 300000 | sed "s/^/line /"']
+                & MULTIPLEX(outputs=[str(name) for name in out_names],
+                            keep=False, splice=True))
+    cpu = time.process_time() - start
+    reader.join()
+    os.close(read_fd)
+
+    assert return_code == 0
+    assert b"".join(received) == expected
+    for out_name in out_names:
+        assert out_name.read_bytes() == expected
+    # Waiting for the terminal, rather than spinning
+    assert cpu < 0.5
+
+
+def gated_writer(overflow):
+    """A _Writer of 4 bytes, writing to a list once the gate is open."""
+    gate = threading.Event()
+    written = []
+
+    def write(data):
+        gate.wait()
+        written.append(data)
+    return _Writer('gated', write, overflow=overflow, size=4), gate, written
+
+
+def test_writer_spill():
+    """What does not fit in the queue is held in order, none is lost."""
+    writer, gate, written = gated_writer('spill')
+    buffers = [b"%d\n" % n for n in range(100)]
+    for data in buffers:
+        writer.put(data)
+    assert writer.spilled > 0
+    gate.set()
+    writer.close()
+    assert b"".join(written) == b"".join(buffers)
+
+
+def test_writer_drop():
+    """What does not fit in the queue is dropped, and counted."""
+    writer, gate, written = gated_writer('drop')
+    for n in range(100):
+        writer.put(b"%02d" % n)
+    gate.set()
+    writer.close()
+    assert len(written) + writer.dropped // 2 == 100
+    assert written == [b"%02d" % n for n in range(len(written))]
+
+
+def test_writer_block():
+    """Past the queue, put() waits for the output."""
+    writer, gate, written = gated_writer('block')
+    putter = threading.Thread(target=lambda: [writer.put(b"x") for _ in range(10)])
+    putter.start()
+    putter.join(0.2)
+    assert putter.is_alive()
+    gate.set()
+    putter.join()
+    writer.close()
+    assert written == [b"x"] * 10
+
+
+def test_writer_bytes():
+    """The queue is bounded in bytes, whatever the size of the buffers, but
+    takes a larger buffer alone."""
+    gate = threading.Event()
+    written = []
+
+    def write(data):
+        gate.wait()
+        written.append(data)
+    writer = _Writer('bytes', write, overflow='drop', size=1000)
+    writer.put(b"x" * 5000)
+    for _ in range(10):
+        writer.put(b"y" * 400)
+    assert writer.queued == 5000
+    assert writer.dropped == 4000
+    gate.set()
+    writer.close()
+    assert written == [b"x" * 5000]
+
+
+def test_writer_error():
+    """The output failing does not hold up the capture, close() raises."""
+    def write(data):
+        raise OSError("disk full")
+    writer = _Writer('failing', write, size=1)
+    for _ in range(10):
+        writer.put(b"x")
+    with pytest.raises(OSError):
+        writer.close()
+
+
+def test_multiplex_overflow_policy():
+    with pytest.raises(ValueError):
+        MULTIPLEX(overflow='discard')
+
+
+class SlowTerminal(io.StringIO):
+    def write(self, text):
+        time.sleep(0.001)
+        return super().write(text)
+
+
+def test_multiplex_slow_terminal(tmp_path):
+    """A slow terminal, spilled to, still gets all of the output."""
+
+    out_name = tmp_path / 'out.dat'
+    terminal = SlowTerminal()
+    script = 'for n in $(seq 2000); do echo line $n; done'
+
+    with redirect_stdin(empty_pipe()):
+        with patch('sys.stdout', terminal):
+            (return_code, stdout, stderr) = (
+                local['/bin/sh']['-c', script]
+                & MULTIPLEX(outputs=[str(out_name)], overflow='spill', buffered=False))
+
+    expected = "".join("line %d\n" % n for n in range(1, 2001))
+    assert out_name.read_text() == expected
+    assert terminal.getvalue() == expected
+    assert stdout == expected
+
+
+class SlowConverter(object):
+    def __init__(self):
+        self.fed = []
+
+    def feed(self, data):
+        time.sleep(0.001)
+        self.fed.append(data)
+
+
+def test_multiplex_drop_terminal_only(tmp_path, monkeypatch):
+    """With 'drop', only the terminal loses output, converters are fed in
+    their own thread and, as outputs, get all of it."""
+
+    policies = {}
+
+    class Writer(_Writer):
+        def __init__(self, name, write, flush=None, overflow='block', size=QUEUE_SIZE):
+            policies[name] = overflow
+            super().__init__(name, write, flush, overflow, size)
+    monkeypatch.setattr('logtool.multiplex._Writer', Writer)
+
+    out_name = tmp_path / 'out.dat'
+    converter = SlowConverter()
+    script = 'for n in $(seq 2000); do echo line $n; done'
+
+    with redirect_stdin(empty_pipe()):
+        with patch('sys.stdout', SlowTerminal()):
+            (return_code, stdout, stderr) = (
+                local['/bin/sh']['-c', script]
+                & MULTIPLEX(outputs=[str(out_name)], converters=[converter],
+                            overflow='drop', buffered=False, keep=False))
+
+    expected = "".join("line %d\n" % n for n in range(1, 2001))
+    assert out_name.read_text() == expected
+    assert b"".join(converter.fed).decode() == expected
+    assert policies['terminal'] == 'drop'
+    assert policies[str(out_name)] == policies['SlowConverter'] == 'block'
+    assert return_code == 0
+
+
+def test_multiplex_converter_error(tmp_path):
+    """A converter failing is reported apart, the outputs still get all."""
+
+    class FailingConverter(object):
+        def feed(self, data):
+            raise ValueError("broken converter")
+
+    out_name = tmp_path / 'out.dat'
+    converter = FailingConverter()
+    multiplex = MULTIPLEX(outputs=[str(out_name)], converters=[converter], keep=False)
+    with redirect_stdin(empty_pipe()), patch('sys.stdout', io.StringIO()):
+        (return_code, stdout, stderr) = local['/bin/echo']['captured'] & multiplex
+
+    assert return_code == 0
+    assert out_name.read_bytes() == b"captured\n"
+    assert isinstance(multiplex.converter_errors[converter], ValueError)
+
+
+def test_multiplex_queue_bytes(monkeypatch):
+    """A stalled converter holds at most its queue's size in bytes, however
+    large the reads grow."""
+
+    writers = []
+
+    class Writer(_Writer):
+        def __init__(self, name, write, flush=None, overflow='block', size=QUEUE_SIZE):
+            super().__init__(name, write, flush, overflow, 4 * READ_SIZE)
+            self.most = 0
+            writers.append(self)
+
+        def put(self, data):
+            super().put(data)
+            self.most = max(self.most, self.queued)
+    monkeypatch.setattr('logtool.multiplex._Writer', Writer)
+
+    class StalledConverter(object):
+        def __init__(self):
+            self.sizes = []
+
+        def feed(self, data):
+            if not self.sizes:
+                time.sleep(0.5)
+            self.sizes.append(len(data))
+
+    converter = StalledConverter()
+    with redirect_stdin(empty_pipe()), patch('sys.stdout', io.StringIO()):
+        (return_code, stdout, stderr) = (
+            local['/bin/sh']['-c', 'head -c 16000000 /dev/zero']
+            & MULTIPLEX(converters=[converter], keep=False))
+
+    assert return_code == 0
+    assert sum(converter.sizes) == 16000000
+    assert max(converter.sizes) > READ_SIZE
+    [feeder] = [writer for writer in writers if writer.name == 'StalledConverter']
+    assert feeder.most <= max(4 * READ_SIZE, max(converter.sizes))
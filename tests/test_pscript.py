@@ -61,3 +61,17 @@ def test_pscript_append_mode():
     with open(tmp_name, 'r') as fp:
         assert fp.read() == "Hello World\n"
 
+
+def test_pscript_text_live():
+    with NamedTemporaryFile(delete=False) as raw_file:
+        raw_name = raw_file.name
+    text_name = raw_name + '.txt'
+    argv = ["pscript", "--text", text_name, "--command",
+            r"printf '\033[1mbold\033[0m\rBOLD\n'", raw_name]
+    with redirect_stdin(empty_pipe()):
+        assert pscript(argv) == 0
+    with open(text_name, 'r') as fp:
+        lines = fp.read().split('\n')
+    assert lines[0].startswith("Script started")
+    assert lines[1] == "BOLD"
+    assert lines[2].startswith("Script done")
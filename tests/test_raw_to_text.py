@@ -0,0 +1,692 @@
+import io
+import os
+import re
+import sys
+import time
+import bz2
+import gzip
+import lzma
+import html
+import json
+import subprocess
+
+import pytest
+
+from logtool.vendor.raw_to_text import (
+    BOLD, HTML_HEAD, HTML_TAIL, INVERSE, UNDERLINE, RawToHtml, RawToText,
+    index_entry, raw_to_html, raw_to_html_bytes, raw_to_text, raw_to_text_bytes,
+    raw_to_text_charwise, raw_to_text_mmap, read_styles)
+
+from .common import code_snippet_ansi, code_snippet_text, slurp
+
+
+def convert(converter, raw, **kwargs):
+    out = io.StringIO()
+    converter(io.StringIO(raw), out, **kwargs)
+    return out.getvalue()
+
+
+def convert_bytes(raw, **kwargs):
+    out = io.BytesIO()
+    raw_to_text_bytes(io.BytesIO(raw), out, **kwargs)
+    return out.getvalue()
+
+
+def test_code_snippet():
+    """The converted fixture matches the recorded text."""
+    with open(code_snippet_ansi, 'r') as in_f:
+        out = io.StringIO()
+        raw_to_text(in_f, out)
+    assert out.getvalue() == slurp(code_snippet_text)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 8192])
+def test_code_snippet_matches_charwise(chunk_size):
+    """Bulk scanning is identical to the per-character reference."""
+    raw = slurp(code_snippet_ansi)
+    assert (convert(raw_to_text, raw, chunk_size=chunk_size)
+            == convert(raw_to_text_charwise, raw, chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("raw, text", [
+    ("plain\n", "plain\n"),
+    ("abc\bd\n", "abd\n"),
+    ("abcdef\rxy\n", "xy\n"),
+    ("abc\r\n", "abc\n"),
+    ("a\tb\n", "a       b\n"),
+    ("\x1b[1;31mred\x1b[0m\n", "red\n"),
+    ("\x1b]0;title\x07text\n", "text\n"),
+    ("\x1b]0;title\x1b\\text\n", "text\n"),
+    ("\x1b7text", "text"),
+    ("abcdef\x1b[3DX\n", "abcXef\n"),
+    ("abcdef\x1b[3D\x1b[K\n", "abc\n"),
+    ("abcdef\x1b[3D\x1b[1K\n", "    ef\n"),
+    ("abcdef\x1b[2KX\n", "      X\n"),
+    ("abc\x1b[J\x1b[2DX\n", "aXc\n"),
+    ("ab\x1b[5GX\n", "ab  X\n"),
+    ("ab\x1b[3CX\x1b[GY\n", "Yb   X\n"),
+    ("abc\r\x1b[2CX\n", "abX\n"),
+    ("[1/9] cc a.c\r\x1b[K[2/9] cc b.c\n", "[2/9] cc b.c\n"),
+    ("abc\x1b[?1KX\x1b[1;2GY\n", "abcXY\n"),
+    ("no newline", "no newline"),
+])
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 8192])
+def test_sequences(raw, text, chunk_size):
+    """Escape sequences and line controls split across any chunk boundary."""
+    assert convert(raw_to_text, raw, chunk_size=chunk_size) == text
+
+
+def test_partial_flush_threshold():
+    raw = "x" * 20 + "\n"
+    assert (convert(raw_to_text, raw, chunk_size=8, partial_flush_threshold=8)
+            == convert(raw_to_text_charwise, raw, chunk_size=8,
+                       partial_flush_threshold=8))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 65536])
+def test_bytes_code_snippet(chunk_size):
+    """Binary conversion matches the recorded text."""
+    with open(code_snippet_ansi, 'rb') as in_f:
+        raw = in_f.read()
+    assert (convert_bytes(raw, chunk_size=chunk_size).decode()
+            == slurp(code_snippet_text))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 65536])
+def test_bytes_multibyte_split(chunk_size):
+    """Characters split across reads are reassembled before overwriting."""
+    raw = "日本語\x1b[1m😀\x1b[0m\rあ\n".encode()
+    assert convert_bytes(raw, chunk_size=chunk_size) == "あ\n".encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 65536])
+def test_bytes_invalid_utf8(chunk_size):
+    """Malformed output is passed through rather than aborting."""
+    raw = b"ok \xff\xfe \xc3\x1b[0m\xa9 \xe6\x97\n\xf0\x9f"
+    assert (convert_bytes(raw, chunk_size=chunk_size)
+            == b"ok \xff\xfe \xc3\xa9 \xe6\x97\n\xf0\x9f")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4194304])
+def test_mmap_code_snippet(tmp_path, chunk_size):
+    """The memory-mapped path matches the streaming one."""
+    out_file = tmp_path / 'out.txt'
+    with open(code_snippet_ansi, 'rb') as in_f, open(out_file, 'wb') as out_f:
+        raw_to_text_mmap(in_f, out_f, chunk_size=chunk_size)
+    assert slurp(out_file) == slurp(code_snippet_text)
+
+
+def test_mmap_empty_file(tmp_path):
+    """An empty raw log cannot be mapped, it is streamed instead."""
+    raw_file = tmp_path / 'raw.dat'
+    raw_file.write_bytes(b'')
+    out = io.BytesIO()
+    with open(raw_file, 'rb') as in_f:
+        raw_to_text_mmap(in_f, out)
+    assert out.getvalue() == b''
+
+
+@pytest.mark.parametrize("raw", [
+    b"line \x1b[32mgreen\x1b[0m\rover\n" * 500,
+    # Every newline is swallowed by a CSI sequence, no split is at rest
+    b"text\x1b[\n1mmore\n" * 500,
+    # The last newline, at the end of the last piece, is swallowed
+    b"line\n" * 1000 + b"last\x1b[\n",
+])
+def test_mmap_parallel(tmp_path, raw):
+    """Converting pieces in parallel matches a serial conversion."""
+    raw_file = tmp_path / 'raw.dat'
+    raw_file.write_bytes(raw)
+    serial = io.BytesIO()
+    parallel = io.BytesIO()
+    with open(raw_file, 'rb') as in_f:
+        serial_checkpoint = raw_to_text_mmap(in_f, serial)
+        parallel_checkpoint = raw_to_text_mmap(in_f, parallel, jobs=2, parallel_threshold=0)
+    assert parallel.getvalue() == serial.getvalue()
+    assert parallel_checkpoint == serial_checkpoint
+
+
+class Trickle(io.RawIOBase):
+    """A pipe returning a byte per read."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.data[self.offset:self.offset + 1]
+        self.offset += len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+@pytest.mark.parametrize("raw", [
+    b"BZhello world\n",
+    # The whole bzip2 header, but no bzip2 data
+    b"BZh91AY&SY \x1b[1mis\x1b[0m not compressed\n" * 100,
+    b"\x1f\x8b then text\n",
+])
+@pytest.mark.parametrize("chunk_size", [1, 5, 65536])
+def test_magic_bytes_text(tmp_path, raw, chunk_size):
+    """Text which starts with magic bytes, but is not compressed, is converted."""
+    # As converted without its first byte, the magic bytes no longer first
+    text = convert_bytes(raw[:1]) + convert_bytes(raw[1:])
+    assert convert_bytes(raw, chunk_size=chunk_size) == text
+
+    out = io.BytesIO()
+    raw_to_text_bytes(Trickle(raw), out, chunk_size=chunk_size)
+    assert out.getvalue() == text
+
+    raw_file = tmp_path / 'raw.dat'
+    raw_file.write_bytes(raw)
+    out = io.BytesIO()
+    with open(raw_file, 'rb') as in_f:
+        raw_to_text_mmap(in_f, out, chunk_size=chunk_size)
+    assert out.getvalue() == text
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, bz2.compress, lzma.compress])
+@pytest.mark.parametrize("chunk_size", [1, 5, 65536])
+def test_compressed_input(tmp_path, compress, chunk_size):
+    """Compressed raw output is converted as it is decompressed."""
+    raw = slurp(code_snippet_ansi).encode()
+    # Concatenated streams, as appended to
+    compressed = compress(raw[:100]) + compress(raw[100:])
+    text = convert_bytes(raw)
+    assert convert_bytes(compressed, chunk_size=chunk_size) == text
+    assert text.decode() == slurp(code_snippet_text)
+
+    raw_file = tmp_path / 'raw.dat.z'
+    raw_file.write_bytes(compressed)
+    out = io.BytesIO()
+    with open(raw_file, 'rb') as in_f:
+        raw_to_text_mmap(in_f, out, chunk_size=chunk_size, jobs=2, parallel_threshold=0)
+    assert out.getvalue() == text
+
+    out = io.BytesIO()
+    raw_to_text_bytes(Trickle(compressed), out, chunk_size=chunk_size)
+    assert out.getvalue() == text
+
+    out, html_out = io.BytesIO(), io.BytesIO()
+    raw_to_html_bytes(io.BytesIO(raw), out)
+    raw_to_html_bytes(io.BytesIO(compressed), html_out)
+    assert html_out.getvalue() == out.getvalue()
+
+
+@pytest.mark.parametrize("chunk_size", [65536, 100003])
+def test_numpy_control_bytes(monkeypatch, chunk_size):
+    """Locating the control bytes with NumPy changes nothing but the speed."""
+    pytest.importorskip("numpy")
+    blob = bytes(48 + n % 64 for n in range(5000))
+    raw = (blob + b"\x1b[1;32m\xc3\xa9" + blob + b"\b\b\bX\r" + blob[:100]
+           + b"\x1b]0;title\x07\xff\n" + blob + b"\r50%\r100%\n") * 40
+    converted = convert_bytes(raw, chunk_size=chunk_size)
+    monkeypatch.setattr("logtool.vendor.raw_to_text.numpy", False)
+    assert converted == convert_bytes(raw, chunk_size=chunk_size)
+
+
+def test_numpy_lazy_import():
+    """NumPy is only imported once a chunk is large enough to use it."""
+    pytest.importorskip("numpy")
+    script = ("import sys, io\n"
+              "from logtool.vendor import raw_to_text as rtt\n"
+              "rtt.raw_to_text_bytes(io.BytesIO(b'small\\n'), io.BytesIO())\n"
+              "print('numpy' in sys.modules, rtt.numpy)\n"
+              "rtt.raw_to_text_bytes(io.BytesIO(b'x' * rtt.NUMPY_MIN_CHUNK), io.BytesIO(),\n"
+              "                      chunk_size=rtt.NUMPY_MIN_CHUNK)\n"
+              "print('numpy' in sys.modules, bool(rtt.numpy))\n")
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert result.stdout.split() == ['False', 'None', 'True', 'True']
+
+
+@pytest.mark.parametrize("options, converter", [([], raw_to_text_bytes),
+                                                 (['--html'], raw_to_html_bytes)])
+def test_command_line(options, converter):
+    """Run as a script, the module converts its standard input."""
+    raw = b"plain \x1b[1mbold\x1b[0m\rPLAIN\n"
+    result = subprocess.run([sys.executable, '-m', 'logtool.vendor.raw_to_text', '-s', '4'] + options,
+                            input=raw, capture_output=True,
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert result.returncode == 0, result.stderr
+    out = io.BytesIO()
+    converter(io.BytesIO(raw), out)
+    assert result.stdout == out.getvalue()
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 4096])
+def test_converter_feed(size):
+    """Feeding pieces of any size gives the same text as a one-shot conversion."""
+    with open(code_snippet_ansi, 'rb') as in_f:
+        raw = in_f.read()
+    out = io.BytesIO()
+    converter = RawToText(out)
+    for n in range(0, len(raw), size):
+        converter.feed(raw[n:n + size])
+        # Every completed line has been written
+        assert out.getvalue().count(b'\n') == raw[:n + size].count(b'\n')
+    converter.close()
+    assert out.getvalue() == convert_bytes(raw)
+
+
+def test_converter_close_partial_line():
+    out = io.StringIO()
+    converter = RawToText(out, binary=False)
+    converter.feed("done\nprogress 50%\rprogress 100%")
+    assert out.getvalue() == "done\n"
+    converter.close()
+    assert out.getvalue() == "done\nprogress 100%"
+
+
+def test_cursor_writes_scale():
+    """Writes moving back along a line take linear time, runs being merged."""
+    def seconds(n):
+        raw = b"a" * n + b"\x1b[2Dx" * n + b"\n"
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            text = convert_bytes(raw)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert text == b"x" * (n - 1) + b"a\n"
+        return best
+    # Quadratic time would take 16 times as long
+    assert seconds(16000) < 8 * seconds(4000) + 0.05
+
+
+def test_wide_writes_scale():
+    """Writes splitting wide characters, and marks after them, only look at the runs around them."""
+    def seconds(n):
+        raw = "字".encode() * n + "\x1b[3D́x".encode() * (n // 2) + b"\n"
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            text = convert_bytes(raw)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert text == "字".encode() * (n // 2 - 1) + b" x" * (n // 2) + "字\n".encode()
+        return best
+    # Joining the line on each write would take about 64 times as long
+    assert seconds(32000) < 16 * seconds(4000) + 0.05
+
+
+@pytest.mark.parametrize("split", [0, 5, 9, 14, 21, 27, 33])
+def test_converter_checkpoint(split):
+    """A conversion continued from a checkpoint matches a single conversion."""
+    raw = "one\nt\xe9\x1b[1mwo\x1b[0m\rTWO\nthr\x1b]0;x\x07ee".encode()
+    out = io.BytesIO()
+    converter = RawToText(out)
+    converter.feed(raw[:split])
+    checkpoint = json.loads(json.dumps(converter.checkpoint()))
+    converter.close()
+    text = out.getvalue()
+    out = io.BytesIO(text[:len(text) - checkpoint['tail']])
+    out.seek(0, io.SEEK_END)
+    converter = RawToText(out)
+    converter.restore(checkpoint)
+    converter.feed(raw[split:])
+    converter.close()
+    assert out.getvalue() == convert_bytes(raw)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 100, 8192])
+def test_long_line_runs(chunk_size):
+    """Overwrites and backspaces cutting into the runs of a long line."""
+    blob = "".join(chr(48 + n % 64) for n in range(10000))
+    colored = "".join("\x1b[3%dm%d" % (n % 8, n) for n in range(300))
+    raw = (blob + "\b" * 5000 + "!\n"
+           + colored + "\b\b\bX\r" + blob[:5000] + "\n"
+           + colored + blob + "\r" + "\b" + "start\n")
+    assert (convert(raw_to_text, raw, chunk_size=chunk_size)
+            == convert(raw_to_text_charwise, raw, chunk_size=chunk_size))
+
+
+def test_converter_line_runs():
+    """The line is held as runs of text, not as characters."""
+    converter = RawToText(io.StringIO(), binary=False)
+    converter.feed("x" * 100000)
+    assert converter.line_len == 100000
+    assert len(converter.line) < 100
+    converter.feed("".join("\x1b[1m%d\x1b[0m" % n for n in range(1000)))
+    assert len(converter.line) < 200
+
+
+@pytest.mark.parametrize("chunk_size", [4, 50, 8192])
+def test_progress_frames(chunk_size):
+    """
+    Superseded progress frames are skipped with the same result as when each
+    CR ends a chunk, so none are.
+    """
+    frames = "".join("\r\x1b[K\x1b[32m%3d%%\x1b[0m |%-20s|" % (n, "#" * (n // 5))
+                     for n in range(101))
+    raw = ("pip install\n" + frames + "\n"
+           + frames + "\r\x1b[K\r\n"
+           + frames + "\r\x1b[Kok\r\r\n"
+           + "\r\x1b[?25l" * 20 + "12345\r\x1b[2K67\x1b[1m\r\n"
+           + frames[:-3] + "\bX\n")
+    assert (convert(raw_to_text, raw, chunk_size=chunk_size)
+            == convert(raw_to_text, raw, chunk_size=1))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 8192])
+def test_max_line(chunk_size):
+    """Long lines are split into pieces ending with the marker."""
+    raw = "a" * 25 + "\n" + "x" * 13 + "\x1b[31m" + "y" * 10 + "\rz\n" + "b" * 10
+    text = ("aaaaaaaaaa+\naaaaaaaaaa+\naaaaa\n"
+            "xxxxxxxxxx+\nxxxyyyyyyy+\nz\n"
+            "bbbbbbbbbb")
+    assert convert(raw_to_text, raw, chunk_size=chunk_size,
+                   max_line=10, split_marker="+") == text
+
+
+@pytest.mark.parametrize("chunk_size", [1, 8192])
+def test_max_line_progress_frames(chunk_size):
+    """Frames split for being longer than max_line are not skipped."""
+    raw = "\r" + "x" * 12 + "\r\x1b[20G" + "y" + "\rdone\n"
+    text = "xxxxxxxxxx\nxx        \ndone\n"
+    assert convert(raw_to_text, raw, chunk_size=chunk_size, max_line=10) == text
+
+
+def test_converter_max_line_cap():
+    """No more than max_line characters of a line are ever held."""
+    out = io.BytesIO()
+    converter = RawToText(out, max_line=1000)
+    for _ in range(100):
+        converter.feed(b"0123456789abcdef" * 4096)
+        assert converter.line_len <= 1000
+    converter.close()
+    lines = out.getvalue().split(b"\n")
+    assert [len(line) for line in lines] == [1000] * 6553 + [600]
+    assert b"".join(lines) == b"0123456789abcdef" * 4096 * 100
+
+
+@pytest.mark.parametrize("raw, text", [
+    ("日本語\x1b[2Gx\n", " x本語\n"),
+    ("日本語\x1b[4G\x1b[K\n", "日 \n"),
+    ("日本語\x1b[3G\x1b[1K\n", "    語\n"),
+    ("日本\bx\n", "日 x\n"),
+    ("日本\b\bx\n", "日x\n"),
+    ("a日\tb\n", "a日     b\n"),
+    ("😀x\x1b[2Gy\n", " yx\n"),
+    ("éx\x1b[2Gy\n", "éy\n"),
+    ("́̂a\x1b[2Gb\n", "́̂b\n"),
+    ("👍️|\x1b[3G!\n", "👍️!\n"),
+])
+@pytest.mark.parametrize("chunk_size", [1, 2, 8192])
+def test_wide_characters(raw, text, chunk_size):
+    """Wide characters take two columns and combining marks none."""
+    assert convert(raw_to_text, raw, chunk_size=chunk_size) == text
+    assert convert_bytes(raw.encode(), chunk_size=chunk_size) == text.encode()
+
+
+def test_many_clusters():
+    """Clusters are allotted per line, so earlier lines use none up."""
+    lines = "".join(chr(0x4E00 + n) + "\u0301\n" for n in range(2000))
+    raw = lines + "xZ\u0302z\x1b[3GY\n"
+    text = convert(raw_to_text, raw, chunk_size=8192)
+    assert text == lines + "xZ\u0302Y\n"
+    assert convert_bytes(raw.encode()) == text.encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 8192])
+def test_max_line_wide_characters(chunk_size):
+    """A wide character which does not fit goes to the next piece."""
+    raw = "ab日本語xy" * 2 + "\n" + "á" * 6 + "\n"
+    text = ("ab日+\n本語+\nxyab+\n日本+\n語xy\n"
+            + "á" * 4 + "+\n" + "á" * 2 + "\n")
+    assert convert(raw_to_text, raw, chunk_size=chunk_size,
+                   max_line=4, split_marker="+") == text
+
+
+@pytest.mark.parametrize("split", [1, 3, 5, 8, 9, 11, 14, 16, 20])
+def test_converter_checkpoint_wide(split):
+    """Wide characters, marks and invalid bytes survive a checkpoint as JSON."""
+    raw = "x́日̂".encode() + b"\xff" + "本̃😀̄z".encode()
+    out = io.BytesIO()
+    converter = RawToText(out)
+    converter.feed(raw[:split])
+    checkpoint = json.loads(json.dumps(converter.checkpoint()))
+    converter.close()
+    text = out.getvalue()
+    out = io.BytesIO(text[:len(text) - checkpoint['tail']])
+    out.seek(0, io.SEEK_END)
+    converter = RawToText(out)
+    converter.restore(checkpoint)
+    converter.feed(raw[split:])
+    converter.close()
+    assert out.getvalue() == convert_bytes(raw)
+
+
+def test_index():
+    """Each line's index entry locates it in the raw input and the text."""
+    raw = "one\n\x1b[31mt\xe9o\x1b[0m\n\nprogress 1\rprogress 2\nlast".encode()
+    out = io.BytesIO()
+    index = io.BytesIO()
+    raw_to_text_bytes(io.BytesIO(raw), out, chunk_size=5, index=index)
+    text = out.getvalue()
+    entries = [index_entry(index, n) for n in range(5)]
+    assert entries == [(0, 0), (4, 4), (18, 9), (19, 10), (41, 21)]
+    assert raw[19:41] == b"progress 1\rprogress 2\n"
+    assert text[21:] == b"last"
+    with pytest.raises(IndexError):
+        index_entry(index, 5)
+    with pytest.raises(ValueError):
+        index_entry(io.BytesIO(b"not an index"), 0)
+
+
+def test_index_split_lines():
+    """The pieces of a split line all index the start of the raw line."""
+    out = io.StringIO()
+    index = io.BytesIO()
+    raw_to_text(io.StringIO("ab\n" + "x" * 25), out, max_line=10, index=index)
+    assert [index_entry(index, n) for n in range(4)] == [
+        (0, 0), (3, 3), (3, 14), (3, 25)]
+    with pytest.raises(IndexError):
+        index_entry(index, 4)
+
+
+def test_mmap_parallel_index(tmp_path):
+    """A parallel conversion writes the same index as a serial one."""
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(slurp(code_snippet_ansi).encode() * 8)
+    indexes = []
+    for jobs in (1, 2):
+        index = io.BytesIO()
+        with open(raw_file, 'rb') as in_f:
+            raw_to_text_mmap(in_f, io.BytesIO(), jobs=jobs, parallel_threshold=0,
+                             index=index)
+        indexes.append(index.getvalue())
+    assert indexes[0] == indexes[1]
+
+
+@pytest.mark.parametrize("raw", [
+    # No piece after the first ends at rest
+    b"start\x1b]0;" + b"swallowed by an unterminated OSC\n" * 2000,
+    # A partial line and an SGR left set span the piece boundaries
+    b"".join(b"\x1b[3%dmline %d, \x1b[1mbold" % (n % 8, n) + b"\n" * (n % 3 > 0)
+             for n in range(3000)),
+])
+def test_mmap_parallel_resume(tmp_path, raw):
+    """Pieces which do not start at rest are continued from the one before."""
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(raw)
+    results = []
+    for jobs in (1, 2):
+        out, index, styles = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        with open(raw_file, 'rb') as in_f:
+            checkpoint = raw_to_text_mmap(in_f, out, jobs=jobs, parallel_threshold=0,
+                                          index=index, styles=styles)
+        results.append((out.getvalue(), index.getvalue(), styles.getvalue(), checkpoint))
+    assert results[0] == results[1]
+
+
+def test_mmap_parallel_pen(tmp_path):
+    """A color left set across piece boundaries styles the pieces after."""
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(b"".join(b"\x1b[3%dmline %d\n" % (n % 8, n) for n in range(4000)))
+    tables = []
+    for jobs in (1, 4):
+        styles = io.BytesIO()
+        with open(raw_file, 'rb') as in_f:
+            raw_to_text_mmap(in_f, io.BytesIO(), jobs=jobs, parallel_threshold=0,
+                             styles=styles)
+        tables.append(list(read_styles(io.BytesIO(styles.getvalue()))))
+    assert tables[0] == tables[1]
+    assert len(tables[0]) == 4000
+
+
+def html_lines(raw, chunk_size=8192, **kwargs):
+    """The lines rendered from raw, without the document around them."""
+    out = io.StringIO()
+    raw_to_html(io.StringIO(raw), out, chunk_size=chunk_size, **kwargs)
+    document = out.getvalue()
+    head = HTML_HEAD.split('%s')[0]
+    assert document.startswith(head) and document.endswith(HTML_TAIL)
+    return document[document.index('<pre class="ansi">\n') + 19:-len(HTML_TAIL)]
+
+
+@pytest.mark.parametrize("raw, lines", [
+    ("a <b> & c\n", "a &lt;b&gt; &amp; c\n"),
+    ("\x1b[1;31mred\x1b[0m plain\n", '<span class="bold fg1">red</span> plain\n'),
+    ("\x1b[92mbright\x1b[39m\n", '<span class="fg10">bright</span>\n'),
+    ("\x1b[38;5;208mx\x1b[48:2::1:2:3my\n",
+     '<span style="color: #ff8700">x</span>'
+     '<span style="color: #ff8700; background-color: #010203">y</span>\n'),
+    ("\x1b[7mi\x1b[34mj\x1b[m\n",
+     '<span class="fgi bgi">i</span><span class="fgi bg4">j</span>\n'),
+    ("\x1b[4mspan\nlines\x1b[24m\n",
+     '<span class="underline">span</span>\n<span class="underline">lines</span>\n'),
+    ("\x1b[31mred\x1b[0m\rb\n", 'b\n'),
+    ("abc\x1b[2D\x1b[1mX\x1b[m\n", 'a<span class="bold">X</span>c\n'),
+    ("\x1b[32m0%\r\x1b[33m50%\r100%\x1b[m\n", '<span class="fg3">100%</span>\n'),
+    ("a\x1b[1m\tb\n", 'a<span class="bold">       b</span>\n'),
+    ("\x1b[?1h\x1b[>4;2mplain\n", 'plain\n'),
+])
+@pytest.mark.parametrize("chunk_size", [1, 8192])
+def test_html(raw, lines, chunk_size):
+    """SGR sequences style the text of each line in spans."""
+    assert html_lines(raw, chunk_size) == lines
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 8192])
+def test_html_code_snippet(chunk_size):
+    """Without its tags, the HTML is the text."""
+    raw = slurp(code_snippet_ansi)
+    lines = html_lines(raw, chunk_size, max_line=40, split_marker='<')
+    assert html.unescape(re.sub('<[^>]*>', '', lines)) == convert(
+        raw_to_text, raw, max_line=40, split_marker='<')
+    assert lines.count('<span') == lines.count('</span>') > 0
+
+
+def test_html_bytes():
+    """Binary streams are rendered as for text ones."""
+    raw = slurp(code_snippet_ansi)
+    out = io.BytesIO()
+    raw_to_html_bytes(io.BytesIO(raw.encode()), out, chunk_size=7, title="a & b")
+    document = out.getvalue().decode()
+    assert "<title>a &amp; b</title>" in document
+    text = io.StringIO()
+    raw_to_html(io.StringIO(raw), text, title="a & b")
+    assert document == text.getvalue()
+
+
+def test_html_checkpoint():
+    """The styles of the line and the pen are restored from a checkpoint."""
+    raw = b"\x1b[1mbold \x1b[32mgreen\rB\x1b[0m and \x1b[4munderlined\n"
+    whole = io.BytesIO()
+    converter = RawToHtml(whole)
+    converter.feed(raw)
+    converter.close()
+    for split in (8, 20, 30):
+        out = io.BytesIO()
+        converter = RawToHtml(out)
+        converter.feed(raw[:split])
+        checkpoint = json.loads(json.dumps(converter.checkpoint()))
+        converter = RawToHtml(out)
+        converter.restore(checkpoint)
+        converter.feed(raw[split:])
+        converter.close()
+        assert out.getvalue() == whole.getvalue()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 8192])
+def test_styles(chunk_size):
+    """The style table locates the styled runs of the unchanged text."""
+    raw = ("plain \x1b[1;31mred\x1b[0m\n\t\xe9\x1b[4;38;5;208mo\x1b[48;2;1;2;3mrgb\x1b[m\n"
+           "\x1b[7m0%\r50%\x1b[27m!\n").encode()
+    out = io.BytesIO()
+    styles = io.BytesIO()
+    raw_to_text_bytes(io.BytesIO(raw), out, chunk_size=chunk_size, styles=styles)
+    text = out.getvalue()
+    assert text == convert_bytes(raw)
+    runs = list(read_styles(styles))
+    assert runs == [(6, 3, (BOLD, 1, None)),
+                    (20, 1, (UNDERLINE, 208, None)),
+                    (21, 3, (UNDERLINE, 208, '#010203')),
+                    (25, 3, (INVERSE, None, None))]
+    assert [text[offset:offset + length] for offset, length, _ in runs] == [
+        b"red", b"o", b"rgb", b"50%"]
+    assert list(read_styles(styles, 21, 25)) == runs[2:3]
+    with pytest.raises(ValueError):
+        read_styles(io.BytesIO(b"not a style table"))
+
+
+def test_styles_checkpoint():
+    """A conversion continued from a checkpoint continues the style table."""
+    raw = b"a\x1b[1mb\nc\rd\x1b[0me\n\x1b[32mf"
+    whole = io.BytesIO()
+    raw_to_text_bytes(io.BytesIO(raw), io.BytesIO(), styles=whole)
+    for split in range(len(raw)):
+        styles = io.BytesIO()
+        converter = RawToText(io.BytesIO(), styles=styles)
+        converter.feed(raw[:split])
+        checkpoint = json.loads(json.dumps(converter.checkpoint()))
+        converter = RawToText(io.BytesIO(), styles=styles)
+        converter.restore(checkpoint)
+        converter.feed(raw[split:])
+        converter.close()
+        assert styles.getvalue() == whole.getvalue()
+
+
+def test_styles_resume():
+    """A conversion closed, then resumed, writes the style table once."""
+    raw = b"plain\n\x1b[1mbo\x1b[0m\x1b[4mld\x1b[0m! \x1b[1mmore\x1b[0m\n\x1b[32mgreen"
+    whole = io.BytesIO()
+    raw_to_text_bytes(io.BytesIO(raw), io.BytesIO(), styles=whole)
+    for split in range(len(raw)):
+        out, styles = io.BytesIO(), io.BytesIO()
+        converter = RawToText(out, styles=styles)
+        converter.feed(raw[:split])
+        checkpoint = json.loads(json.dumps(converter.checkpoint()))
+        converter.close()
+        text = out.getvalue()
+        out = io.BytesIO(text[:len(text) - checkpoint['tail']])
+        out.seek(0, io.SEEK_END)
+        table = styles.getvalue()
+        styles = io.BytesIO(table[:len(table) - checkpoint['styles_tail']])
+        styles.seek(0, io.SEEK_END)
+        converter = RawToText(out, styles=styles)
+        converter.restore(checkpoint)
+        converter.feed(raw[split:])
+        converter.close()
+        assert list(read_styles(styles)) == list(read_styles(whole)), split
+
+
+def test_mmap_parallel_styles(tmp_path):
+    """A parallel conversion writes the same style table as a serial one."""
+    raw_file = tmp_path / "raw"
+    raw_file.write_bytes(slurp(code_snippet_ansi).encode() * 8)
+    tables = []
+    checkpoints = []
+    for jobs in (1, 2):
+        styles = io.BytesIO()
+        with open(raw_file, 'rb') as in_f:
+            checkpoints.append(raw_to_text_mmap(in_f, io.BytesIO(), jobs=jobs,
+                                                parallel_threshold=0, styles=styles))
+        tables.append(styles.getvalue())
+    assert tables[0] == tables[1]
+    assert len(list(read_styles(io.BytesIO(tables[0])))) > 8
+    assert checkpoints[0]['text_offset'] == checkpoints[1]['text_offset']